@@ -0,0 +1,84 @@
+"""
+Measures request throughput through ConnectionPool for increasing pool sizes
+against a live RabbitMQ broker. A set of echo worker processes consume from a
+dedicated queue and reply immediately, so the numbers reflect the proxy-side
+publishing and reply handling only.
+
+Usage:
+
+    python -m benchmarks.bench_amqp_pool [nb_requests] [nb_threads]
+"""
+from concurrent.futures import ThreadPoolExecutor
+from http_proxy.amqp_pool import ConnectionPool
+from http_proxy.pending import PendingCalls
+from typing import Any
+from unicornbottle.rabbitmq import rabbitmq_connect
+import multiprocessing
+import pika
+import sys
+import time
+import uuid
+
+QUEUE = 'bench_rpc_queue'
+NB_ECHO_WORKERS = 8
+POOL_SIZES = [1, 2, 4, 8]
+
+def echo_worker() -> None:
+    connection = rabbitmq_connect()
+    channel = connection.channel()
+    channel.queue_declare(queue=QUEUE)
+    channel.basic_qos(prefetch_count=100)
+
+    def on_request(ch : Any, method : Any, props : pika.spec.BasicProperties, body : bytes) -> None:
+        ch.basic_publish(exchange='', routing_key=props.reply_to,
+                properties=pika.BasicProperties(correlation_id=props.correlation_id), body=body)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    channel.basic_consume(queue=QUEUE, on_message_callback=on_request)
+    channel.start_consuming()
+
+def run(pool_size : int, nb_requests : int, nb_threads : int) -> float:
+    pending = PendingCalls()
+    pool = ConnectionPool(pool_size, lambda ch, method, props, body: pending.resolve(props.correlation_id, body))
+    pool.start()
+
+    body = b"x" * 2048
+
+    def request(_ : int) -> None:
+        corr_id = str(uuid.uuid4())
+        call = pending.register(corr_id, 30)
+        try:
+            pool.publish(corr_id, body, routing_key=QUEUE)
+            if call.wait(30) is None:
+                raise Exception("Timed out.")
+        finally:
+            pending.discard(corr_id)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(nb_threads) as executor:
+        list(executor.map(request, range(nb_requests)))
+    elapsed = time.perf_counter() - start
+
+    pool.stop()
+
+    return nb_requests / elapsed
+
+def main() -> None:
+    nb_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    nb_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+
+    workers = [multiprocessing.Process(target=echo_worker, daemon=True) for _ in range(NB_ECHO_WORKERS)]
+    for worker in workers:
+        worker.start()
+    time.sleep(2)
+
+    try:
+        for pool_size in POOL_SIZES:
+            rate = run(pool_size, nb_requests, nb_threads)
+            print("pool_size=%d %10.0f requests/s" % (pool_size, rate))
+    finally:
+        for worker in workers:
+            worker.terminate()
+
+if __name__ == "__main__":
+    main()
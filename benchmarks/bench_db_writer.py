@@ -0,0 +1,88 @@
+"""
+Measures how many rows per second the bulk writer can push through to
+Postgres. A stand-in session that consumes the COPY stream / INSERT values
+without a server is used by default, so the numbers reflect the client side
+cost only. Pass a target GUID to run against the real database instead.
+
+Usage:
+
+    python -m benchmarks.bench_db_writer [nb_rows] [target_guid]
+"""
+from contextlib import contextmanager
+from http_proxy import db_writer
+from http_proxy.db_writer import BulkWriter
+from tests.test_base import TestBase
+from typing import Any, Iterator
+from unicornbottle.models import RequestResponse
+from unittest.mock import MagicMock
+import sys
+import time
+
+class StandInCursor(object):
+    def __init__(self, session : 'StandInSession'):
+        self.session = session
+
+    def copy_expert(self, sql : str, buf : Any) -> None:
+        for _ in buf:
+            self.session.nb_rows += 1
+
+    def close(self) -> None:
+        pass
+
+class StandInSession(object):
+    """
+    Behaves like the subset of a SQLAlchemy session used by BulkWriter.
+    """
+    def __init__(self) -> None:
+        self.nb_rows = 0
+        self.metadata = MagicMock(id=1)
+
+    def execute(self, stmt : Any) -> Any:
+        result = MagicMock()
+        result.scalar.return_value = self.metadata
+        return result
+
+    def add(self, obj : Any) -> None:
+        pass
+
+    def flush(self) -> None:
+        pass
+
+    def commit(self) -> None:
+        pass
+
+    def connection(self) -> Any:
+        conn = MagicMock()
+        conn.connection.cursor.return_value = StandInCursor(self)
+        return conn
+
+def main() -> None:
+    nb_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    target_guid = sys.argv[2] if len(sys.argv) > 2 else None
+
+    session = StandInSession()
+
+    @contextmanager
+    def stand_in_connect(target_guid : str) -> Iterator[StandInSession]:
+        yield session
+
+    base = TestBase()
+    rows = [RequestResponse.createFromDWI(base._dwi()) for _ in range(nb_rows)]
+
+    for mode in (db_writer.MODE_COPY, db_writer.MODE_INSERT):
+        if target_guid is None:
+            writer = BulkWriter(mode=mode, connect=stand_in_connect)
+            guid = base.TEST_GUID.decode('utf-8')
+        else:
+            writer = BulkWriter(mode=mode)
+            guid = target_guid
+
+        start = time.perf_counter()
+        for i in range(0, nb_rows, writer.max_rows):
+            writer.flush({guid: rows[i:i + writer.max_rows]})
+        elapsed = time.perf_counter() - start
+
+        print("%-6s %8d rows in %6.2fs: %10.0f rows/s" % (mode, nb_rows, elapsed, nb_rows / elapsed))
+
+if __name__ == "__main__":
+    main()
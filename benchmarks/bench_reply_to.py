@@ -0,0 +1,67 @@
+"""
+Compares RPC round-trip latency when replies are received through a
+declared exclusive reply queue and through RabbitMQ direct reply-to, against
+a live broker. Requests are sent one at a time through a single-connection
+ConnectionPool to echo workers that reply immediately, so the numbers
+reflect the broker's reply routing rather than throughput.
+
+Usage:
+
+    python -m benchmarks.bench_reply_to [nb_requests]
+"""
+from benchmarks.bench_amqp_pool import NB_ECHO_WORKERS, QUEUE, echo_worker
+from http_proxy.amqp_pool import ConnectionPool
+from http_proxy.pending import PendingCalls
+from typing import List
+import multiprocessing
+import statistics
+import sys
+import time
+import uuid
+
+def run(direct_reply_to : bool, nb_requests : int) -> List[float]:
+    pending = PendingCalls()
+    pool = ConnectionPool(1, lambda ch, method, props, body: pending.resolve(props.correlation_id, body),
+            direct_reply_to=direct_reply_to)
+    pool.start()
+
+    body = b"x" * 2048
+    latencies = []
+    try:
+        for _ in range(nb_requests):
+            corr_id = str(uuid.uuid4())
+            call = pending.register(corr_id, 30)
+
+            start = time.perf_counter()
+            pool.publish(corr_id, body, routing_key=QUEUE)
+            if call.wait(30) is None:
+                raise Exception("Timed out.")
+            latencies.append(time.perf_counter() - start)
+
+            pending.discard(corr_id)
+    finally:
+        pool.stop()
+
+    return latencies
+
+def main() -> None:
+    nb_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+
+    workers = [multiprocessing.Process(target=echo_worker, daemon=True) for _ in range(NB_ECHO_WORKERS)]
+    for worker in workers:
+        worker.start()
+    time.sleep(2)
+
+    try:
+        for name, direct_reply_to in [("reply queue", False), ("direct reply-to", True)]:
+            latencies = sorted(run(direct_reply_to, nb_requests))
+            print("%-16s mean=%.3fms p50=%.3fms p99=%.3fms" % (name,
+                statistics.mean(latencies) * 1000,
+                latencies[len(latencies) // 2] * 1000,
+                latencies[int(len(latencies) * 0.99)] * 1000))
+    finally:
+        for worker in workers:
+            worker.terminate()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Measures how long a worker takes to start, from launching the interpreter to
+having constructed its RPCServer, i.e. everything that happens before it
+connects to RabbitMQ. Each run uses a fresh interpreter so that nothing is
+cached in memory. The slowest imports of the last run are listed to show
+where the time goes.
+
+Exits with a non-zero status if the median exceeds STARTUP_BUDGET.
+
+Usage:
+
+    python -m benchmarks.bench_worker_startup [nb_runs]
+"""
+from typing import List, Tuple
+import statistics
+import subprocess
+import sys
+import time
+
+STARTUP_BUDGET = 1.0
+NB_SLOWEST_IMPORTS = 10
+
+SCRIPT = "from http_proxy import rpc_server; rpc_server.RPCServer(passthrough=rpc_server.PASSTHROUGH)"
+
+def run(importtime : bool = False) -> subprocess.CompletedProcess:
+    args = [sys.executable]
+    if importtime:
+        args += ["-X", "importtime"]
+
+    return subprocess.run(args + ["-c", SCRIPT], check=True, stderr=subprocess.PIPE)
+
+def slowest_imports(stderr : bytes) -> List[Tuple[int, str]]:
+    """
+    Parses the output of `-X importtime` and returns the top-level imports
+    with the highest cumulative time, in microseconds. Nested imports are
+    indented and already included in their parent's cumulative time.
+    """
+    imports = []
+    for line in stderr.decode('utf-8').splitlines():
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+
+        name = fields[2][1:]
+        if not name.startswith(" "):
+            imports.append((int(fields[1]), name))
+
+    return sorted(imports, reverse=True)[:NB_SLOWEST_IMPORTS]
+
+def main() -> None:
+    nb_runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    timings = []
+    for _ in range(nb_runs):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+
+    median = statistics.median(timings)
+    print("startup median=%.3fs min=%.3fs max=%.3fs budget=%.3fs" % (median, min(timings),
+        max(timings), STARTUP_BUDGET))
+
+    print("slowest imports:")
+    for cumulative, name in slowest_imports(run(importtime=True).stderr):
+        print("%10.1fms %s" % (cumulative / 1000, name))
+
+    if median > STARTUP_BUDGET:
+        print("Over budget.")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
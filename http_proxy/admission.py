@@ -0,0 +1,280 @@
+from collections import deque
+from http_proxy.backoff import Backoff
+from http_proxy.metrics import registry
+from typing import Deque, List, Optional
+from unicornbottle.rabbitmq import rabbitmq_connect
+import asyncio
+import logging
+import pika
+import pika.exceptions
+import threading
+
+logger = logging.getLogger(__name__)
+
+class ShedException(Exception):
+    pass
+
+class Waiter(object):
+    """
+    A request waiting for a slot. Exactly one of `event` or `future` is set,
+    depending on whether the requester is a thread or a coroutine.
+    """
+
+    def __init__(self, loop : Optional[asyncio.AbstractEventLoop] = None):
+        self.granted = False
+        self.loop = loop
+        self.event : Optional[threading.Event] = None
+        self.future : Optional[asyncio.Future] = None
+
+        if loop is None:
+            self.event = threading.Event()
+        else:
+            self.future = loop.create_future()
+
+    def grant(self) -> None:
+        """
+        Hands a slot over to this waiter. Must be called with the controller
+        lock held.
+        """
+        self.granted = True
+        if self.event is not None:
+            self.event.set()
+        elif self.loop is not None:
+            self.loop.call_soon_threadsafe(self.set_future_result)
+
+    def set_future_result(self) -> None:
+        if self.future is not None and not self.future.done():
+            self.future.set_result(True)
+
+class AdmissionController(object):
+    """
+    Limits the number of RPCs outstanding at once.
+
+    When workers fall behind, accepting more requests only makes every
+    request wait out REQUEST_TIMEOUT. Instead, requests over the limit wait
+    up to `max_wait` seconds for a slot and are shed if none frees up, so
+    that the requests that are admitted complete in bounded time.
+
+    Requests are also shed while the broker reports more than
+    `max_queue_depth` messages waiting for workers, see QueueDepthMonitor.
+    """
+
+    def __init__(self, max_outstanding : int, max_wait : float = 0.0,
+            max_waiting : int = 1000, max_queue_depth : Optional[int] = None,
+            retry_after : int = 5):
+        """
+        Args:
+            max_outstanding: maximum number of admitted requests at once.
+            max_wait: seconds a request may wait for a slot. Zero sheds
+                immediately.
+            max_waiting: maximum number of requests waiting for a slot.
+            max_queue_depth: if set, shed while the queue depth exceeds it.
+            retry_after: value of the Retry-After header on shed responses.
+        """
+        self.max_outstanding = max_outstanding
+        self.max_wait = max_wait
+        self.max_waiting = max_waiting
+        self.max_queue_depth = max_queue_depth
+        self.retry_after = retry_after
+
+        self.lock = threading.Lock()
+        self.outstanding = 0
+        self.waiters : Deque[Waiter] = deque()
+        self.queue_depth : Optional[int] = None
+
+        registry.gauge("admission.outstanding", lambda: self.outstanding)
+        registry.gauge("admission.waiting", lambda: len(self.waiters))
+
+    def overloaded(self) -> bool:
+        return (self.max_queue_depth is not None and self.queue_depth is not None
+                and self.queue_depth > self.max_queue_depth)
+
+    def try_admit(self, loop : Optional[asyncio.AbstractEventLoop] = None) -> Optional[Waiter]:
+        """
+        Admits the request if possible, otherwise queues a waiter if allowed.
+        Must be called with the lock held.
+
+        Args:
+            loop: the event loop of the requester, if it is a coroutine.
+
+        Returns:
+            waiter: None if the request was admitted.
+        Raises:
+            ShedException: if the request must be shed right away.
+        """
+        if self.overloaded():
+            raise ShedException("Queue depth %s over limit." % self.queue_depth)
+
+        if self.outstanding < self.max_outstanding and len(self.waiters) == 0:
+            self.outstanding += 1
+            return None
+
+        if self.max_wait <= 0 or len(self.waiters) >= self.max_waiting:
+            raise ShedException("Too many outstanding requests.")
+
+        waiter = Waiter(loop)
+        self.waiters.append(waiter)
+
+        return waiter
+
+    def acquire(self) -> bool:
+        """
+        Blocks until a slot is available, for up to `max_wait` seconds.
+
+        Returns:
+            admitted: False if the request should be shed. Otherwise,
+                `release` must be called when the request completes.
+        """
+        try:
+            with self.lock:
+                waiter = self.try_admit()
+        except ShedException:
+            return self.shed()
+
+        if waiter is None:
+            return self.admitted()
+
+        assert waiter.event is not None
+        waiter.event.wait(self.max_wait)
+
+        return self.finish_wait(waiter)
+
+    async def acquire_async(self) -> bool:
+        """
+        Same as `acquire`, but waits without blocking the event loop. Must
+        be called from the loop.
+        """
+        try:
+            with self.lock:
+                waiter = self.try_admit(asyncio.get_running_loop())
+        except ShedException:
+            return self.shed()
+
+        if waiter is None:
+            return self.admitted()
+
+        assert waiter.future is not None
+        try:
+            await asyncio.wait_for(waiter.future, self.max_wait)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # A slot may have been handed over just before the cancellation.
+            # The caller won't release it, so give it back.
+            with self.lock:
+                granted = waiter.granted
+                if not granted:
+                    self.waiters.remove(waiter)
+
+            if granted:
+                self.release()
+
+            raise
+
+        return self.finish_wait(waiter)
+
+    def finish_wait(self, waiter : Waiter) -> bool:
+        """
+        Resolves the race between a waiter timing out and a slot being
+        handed to it at the same time.
+        """
+        with self.lock:
+            if not waiter.granted:
+                self.waiters.remove(waiter)
+
+        if waiter.granted:
+            return self.admitted()
+
+        return self.shed()
+
+    def admitted(self) -> bool:
+        registry.inc("admission.admitted")
+        return True
+
+    def shed(self) -> bool:
+        registry.inc("admission.shed")
+        return False
+
+    def release(self) -> None:
+        """
+        Frees the slot of a completed request, handing it directly to the
+        oldest waiter if there is one.
+        """
+        with self.lock:
+            if len(self.waiters) > 0:
+                self.waiters.popleft().grant()
+            else:
+                self.outstanding -= 1
+
+class QueueDepthMonitor(object):
+    """
+    Periodically reads the number of messages waiting in the worker queues
+    and reports it to an AdmissionController.
+    """
+
+    INTERVAL = 2.0
+
+    def __init__(self, controller : AdmissionController, queues : List[str]):
+        """
+        Args:
+            controller: the controller to update.
+            queues: names of the queues workers consume from.
+        """
+        self.controller = controller
+        self.queues = queues
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="queue-depth-monitor", daemon=True)
+
+        registry.gauge("admission.queue_depth", lambda: self.controller.queue_depth or 0)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+        self.thread.join(timeout=5)
+
+    def run(self) -> None:
+        """
+        Polls the queue depth every INTERVAL seconds until `stop` is called.
+        On any failure the depth is cleared, which fails open as the
+        outstanding limit still applies, and the connection is closed and
+        reopened after a backoff.
+        """
+        backoff = Backoff()
+        connection = None
+        try:
+            while not self.stopping.is_set():
+                delay = self.INTERVAL
+                try:
+                    if connection is None or not connection.is_open:
+                        connection = rabbitmq_connect()
+                        channel = connection.channel()
+
+                    depth = 0
+                    for queue in self.queues:
+                        result = channel.queue_declare(queue=queue, passive=True)
+                        depth += result.method.message_count
+
+                    self.controller.queue_depth = depth
+                    backoff.reset()
+                except Exception:
+                    logger.exception("Failed to read queue depth.")
+                    self.controller.queue_depth = None
+
+                    self.close(connection)
+                    connection = None
+                    delay += backoff.next_delay()
+
+                self.stopping.wait(delay)
+        finally:
+            self.close(connection)
+
+    def close(self, connection : Optional[pika.BlockingConnection]) -> None:
+        if connection is None or not connection.is_open:
+            return
+
+        try:
+            connection.close()
+        except Exception:
+            logger.debug("Failed to close queue depth connection.", exc_info=True)
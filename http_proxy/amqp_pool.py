@@ -0,0 +1,189 @@
+from functools import partial
+from http_proxy.backoff import Backoff
+from pika.adapters.blocking_connection import BlockingChannel
+from typing import Any, Callable, List, Optional
+from unicornbottle.rabbitmq import rabbitmq_connect
+import logging
+import pika
+import pika.exceptions
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# Pseudo-queue for RabbitMQ direct reply-to. Replies published to it are
+# delivered straight to the consumer on the requesting channel without a
+# queue being declared. See https://www.rabbitmq.com/direct-reply-to.html
+DIRECT_REPLY_TO = 'amq.rabbitmq.reply-to'
+
+class ShardNotReadyException(Exception):
+    pass
+
+class Shard(object):
+    """
+    One RabbitMQ connection with its own I/O thread, channel and reply queue.
+
+    pika connections are not thread-safe, so everything touching the
+    connection happens in the shard's thread. Other threads hand work over
+    through `add_callback_threadsafe`.
+    """
+
+    RECONNECT_DELAY = 1.0
+
+    def __init__(self, nb : int, on_response : Callable, direct_reply_to : bool = False):
+        """
+        Args:
+            nb: the shard number, used for naming the thread.
+            on_response: pika consumer callback for replies.
+            direct_reply_to: receive replies through DIRECT_REPLY_TO instead
+                of declaring an exclusive reply queue.
+        """
+        self.nb = nb
+        self.on_response = on_response
+        self.direct_reply_to = direct_reply_to
+
+        self.connection : Optional[pika.BlockingConnection] = None
+        self.channel : Optional[BlockingChannel] = None
+        self.callback_queue : Optional[str] = None
+
+        self.ready = threading.Event()
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name="amqp-shard-%s" % nb, daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def connect(self) -> None:
+        """
+        Opens the connection and starts consuming replies. Runs in the shard's
+        thread.
+        """
+        self.connection = rabbitmq_connect()
+        self.channel = self.connection.channel()
+
+        if self.direct_reply_to:
+            # Requests must be published on the channel that consumes, which
+            # is already the case as both happen on self.channel.
+            self.callback_queue = DIRECT_REPLY_TO
+        else:
+            result = self.channel.queue_declare(queue='', exclusive=True)
+            self.callback_queue = result.method.queue
+
+        self.channel.basic_consume(queue=self.callback_queue,
+                on_message_callback=self.on_response, auto_ack=True)
+
+    def run(self) -> None:
+        """
+        Keeps the shard connected until `stop` is called. Any failure,
+        including unexpected ones, closes the connection and reconnects after
+        a backoff rather than ending the thread, as requests assigned to a
+        dead shard would otherwise fail until the proxy is restarted.
+        """
+        backoff = Backoff(self.RECONNECT_DELAY)
+        while not self.stopping:
+            try:
+                self.connect()
+                self.ready.set()
+                backoff.reset()
+
+                assert self.channel is not None
+                self.channel.start_consuming()
+            except pika.exceptions.AMQPError:
+                logger.exception("AMQP shard %s lost its connection. Reconnecting." % self.nb)
+            except Exception:
+                logger.exception("AMQP shard %s failed. Reconnecting." % self.nb)
+            finally:
+                self.ready.clear()
+                if not self.stopping:
+                    self.close()
+
+            if not self.stopping:
+                time.sleep(backoff.next_delay())
+
+    def close(self) -> None:
+        """
+        Closes the connection if it is still open. Runs in the shard's thread.
+        """
+        connection = self.connection
+        if connection is None or not connection.is_open:
+            return
+
+        try:
+            connection.close()
+        except Exception:
+            logger.debug("Failed to close AMQP shard %s." % self.nb, exc_info=True)
+
+    def publish(self, routing_key : str, corr_id : str, body : Any) -> None:
+        """
+        Publishes a message with this shard's reply queue as `reply_to`.
+
+        Raises:
+            ShardNotReadyException: if the shard is (re)connecting.
+        """
+        connection, channel, callback_queue = self.connection, self.channel, self.callback_queue
+        if not self.ready.is_set() or connection is None or channel is None:
+            raise ShardNotReadyException("AMQP shard %s is not connected." % self.nb)
+
+        properties = pika.BasicProperties(reply_to=callback_queue, correlation_id=corr_id)
+        connection.add_callback_threadsafe(partial(channel.basic_publish,
+            exchange='', routing_key=routing_key, properties=properties, body=body))
+
+    def stop(self) -> None:
+        self.stopping = True
+
+        connection, channel = self.connection, self.channel
+        if connection is not None and channel is not None and self.ready.is_set():
+            connection.add_callback_threadsafe(channel.stop_consuming)
+
+        self.thread.join(timeout=5)
+
+        if connection is not None and connection.is_open:
+            connection.close()
+
+class ConnectionPool(object):
+    """
+    A fixed-size pool of Shards. Requests are assigned to a shard by hashing
+    their correlation id, and each shard consumes the replies sent to its
+    own reply queue, so both the publish and the reply for a request are
+    handled by the same connection and I/O thread.
+    """
+
+    READY_TIMEOUT = 30
+
+    def __init__(self, size : int, on_response : Callable, direct_reply_to : bool = False):
+        """
+        Args:
+            size: the number of connections to open.
+            on_response: pika consumer callback for replies. Called from the
+                shards' threads.
+            direct_reply_to: see Shard.
+        """
+        self.shards : List[Shard] = [Shard(nb, on_response, direct_reply_to) for nb in range(size)]
+
+    def start(self) -> None:
+        """
+        Starts all shards and waits for them to be connected.
+        """
+        for shard in self.shards:
+            shard.start()
+
+        for shard in self.shards:
+            if not shard.ready.wait(self.READY_TIMEOUT):
+                logger.error("AMQP shard %s failed to connect in time." % shard.nb)
+
+    def shard_for(self, corr_id : str) -> Shard:
+        return self.shards[zlib.crc32(corr_id.encode('utf-8')) % len(self.shards)]
+
+    def publish(self, corr_id : str, body : Any, routing_key : str = 'rpc_queue') -> None:
+        """
+        Publishes a request through the shard that owns its correlation id.
+        """
+        self.shard_for(corr_id).publish(routing_key, corr_id, body)
+
+    def alive(self) -> bool:
+        return all([shard.thread.is_alive() for shard in self.shards])
+
+    def stop(self) -> None:
+        for shard in self.shards:
+            shard.stop()
@@ -0,0 +1,37 @@
+import random
+
+class Backoff(object):
+    """
+    Exponential backoff with full jitter: the n-th delay is drawn uniformly
+    between zero and `base * 2 ** n`, capped at `cap`. Drawing the whole
+    delay at random rather than adding a little jitter to a fixed schedule
+    spreads out clients that failed at the same time, e.g. every worker
+    after a broker restart, so they don't retry in lockstep.
+
+    See https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+    """
+
+    def __init__(self, base : float = 0.5, cap : float = 30.0):
+        """
+        Args:
+            base: upper bound of the first delay, in seconds.
+            cap: upper bound of any delay, in seconds.
+        """
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+
+    def next_delay(self) -> float:
+        """
+        Returns how long to wait before the next attempt.
+        """
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** min(self.attempt, 32)))
+        self.attempt += 1
+
+        return delay
+
+    def reset(self) -> None:
+        """
+        Called after a successful attempt.
+        """
+        self.attempt = 0
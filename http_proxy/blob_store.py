@@ -0,0 +1,104 @@
+from http_proxy.metrics import registry
+from typing import IO, Iterator
+import os
+import tempfile
+
+BLOB_FOLDER = '/var/lib/ub-httpproxy/blobs'
+
+class BlobStore(object):
+    """
+    Content-addressed store for large response bodies on local disk.
+
+    Bodies are stored under their hash, as returned by
+    http_proxy.body_store.hash_body, in two levels of sharded directories so
+    that no single directory grows too large:
+
+        <root>/ab/cd/abcd...
+
+    Blobs are written to a temporary file in their final directory, flushed
+    to disk and then renamed into place, so a blob is either complete or
+    absent and concurrent writers of the same body can't corrupt it. As the
+    address is the hash of the content, an existing blob never needs to be
+    rewritten.
+    """
+
+    READ_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, root : str):
+        """
+        Args:
+            root: folder holding the blobs. Created if it does not exist.
+        """
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, body_hash : str) -> str:
+        if len(body_hash) < 5 or not all([c in "0123456789abcdef" for c in body_hash]):
+            raise ValueError("Invalid body hash %r." % body_hash)
+
+        return os.path.join(self.root, body_hash[0:2], body_hash[2:4], body_hash)
+
+    def exists(self, body_hash : str) -> bool:
+        return os.path.exists(self.path(body_hash))
+
+    def put(self, body_hash : str, content : bytes) -> None:
+        """
+        Stores a body unless it is already present. The blob is durable once
+        this returns, so it is safe to commit rows referencing it.
+
+        Args:
+            body_hash: the hash of `content`.
+            content: the raw body bytes.
+        """
+        path = self.path(body_hash)
+        if os.path.exists(path):
+            return
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+        registry.inc("blob_store.written")
+        registry.inc("blob_store.bytes", len(content))
+
+    def open(self, body_hash : str) -> IO[bytes]:
+        """
+        Opens a blob for reading.
+
+        Raises:
+            FileNotFoundError: if the blob is not in the store.
+        """
+        return open(self.path(body_hash), "rb")
+
+    def iter_chunks(self, body_hash : str, chunk_size : int = READ_CHUNK_SIZE) -> Iterator[bytes]:
+        """
+        Reads a blob lazily, `chunk_size` bytes at a time, so that large
+        bodies don't have to fit in memory.
+
+        Raises:
+            FileNotFoundError: if the blob is not in the store.
+        """
+        with self.open(body_hash) as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+
+                yield chunk
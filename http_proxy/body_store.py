@@ -0,0 +1,262 @@
+from collections import OrderedDict
+from http_proxy.blob_store import BlobStore
+from http_proxy.database_models import ResponseBody
+from http_proxy.metrics import registry
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from typing import Any, Dict, Iterable, Iterator, Optional, Set, Tuple
+from unicornbottle.models import DatabaseWriteItem
+import hashlib
+import logging
+import mitmproxy.net.http
+import mitmproxy.net.http.encoding
+
+logger = logging.getLogger(__name__)
+
+BODY_HASH_HEADER = "X-UB-Body-Hash"
+
+def hash_body(content : bytes) -> str:
+    """
+    Returns the content address for a body. BLAKE2b is used because it is
+    faster than SHA-256 on 64-bit CPUs while still being collision resistant.
+
+    Args:
+        content: the raw body bytes.
+    """
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+class BodyStore(object):
+    """
+    Deduplicates response bodies before they are written to the database.
+
+    Scanners fetch the same error pages, JS bundles and 404 templates over and
+    over. Instead of storing a copy of the body in each RequestResponse row,
+    bodies are stored once per target in the `response_bodies` table and the
+    row only keeps the hash.
+
+    An LRU of recently written hashes is kept per target so that bodies that
+    are known to be in the database are not sent again. An LRU is used
+    rather than a bloom filter because a false positive would mean a body is
+    never written.
+
+    If a BlobStore is passed in, bodies of BLOB_MIN_SIZE bytes or more are
+    written there instead of to Postgres, so that large media and archives
+    don't bloat the database or slow down its writes. The row references
+    them in the same way.
+    """
+
+    MIN_SIZE = 256
+    BLOB_MIN_SIZE = 256 * 1024
+    SEEN_CACHE_SIZE = 100000
+
+    def __init__(self, blob_store : Optional[BlobStore] = None) -> None:
+        """
+        Args:
+            blob_store: where to store large bodies.
+        """
+        self.blob_store = blob_store
+        self.pending : Dict[str, Dict[str, bytes]] = {}
+        self.seen : 'OrderedDict[Tuple[str, str], bool]' = OrderedDict()
+        self.tables_created : Set[str] = set()
+
+    def dedup(self, dwi : DatabaseWriteItem) -> DatabaseWriteItem:
+        """
+        Replaces the response body in a DatabaseWriteItem with a reference to
+        its hash, queueing the body for writing unless it was written recently.
+
+        The response is copied before modifying it because it is the same
+        object that mitmproxy sends back to the client.
+
+        Args:
+            dwi: as read from `db_write_queue`.
+        """
+        response = dwi.response
+        if response is None or response.raw_content is None or len(response.raw_content) < self.MIN_SIZE:
+            return dwi
+
+        content = response.raw_content
+        body_hash = hash_body(content)
+
+        in_blob_store = len(content) >= self.BLOB_MIN_SIZE and self.put_blob(body_hash, content)
+        if not in_blob_store and not self.was_written(dwi.target_guid, body_hash):
+            self.pending.setdefault(dwi.target_guid, {})[body_hash] = content
+
+        stored = response.copy()
+        stored.raw_content = b""
+        stored.headers[BODY_HASH_HEADER] = body_hash
+
+        dwi.response = stored
+
+        return dwi
+
+    def put_blob(self, body_hash : str, content : bytes) -> bool:
+        """
+        Writes a body to the blob store, if there is one. This happens right
+        away, on the database thread, so that the blob is on disk before any
+        row referencing it is committed.
+
+        Returns:
+            stored: False if there is no blob store or the write failed, e.g.
+                because the disk is full. The body is then stored in
+                Postgres instead, where `load_body` finds it all the same.
+        """
+        if self.blob_store is None:
+            return False
+
+        try:
+            self.blob_store.put(body_hash, content)
+        except OSError:
+            logger.exception("Failed to write blob %s, storing it in the database instead." % body_hash)
+            registry.inc("blob_store.failed")
+            return False
+
+        return True
+
+    def was_written(self, target_guid : str, body_hash : str) -> bool:
+        """
+        Returns whether the body was written to this target's database
+        recently.
+
+        Args:
+            target_guid: the target the body belongs to.
+            body_hash: as returned by `hash_body`.
+        """
+        key = (target_guid, body_hash)
+        if key in self.seen:
+            self.seen.move_to_end(key)
+            return True
+
+        return False
+
+    def take(self, target_guid : str) -> Dict[str, bytes]:
+        """
+        Returns and forgets the bodies pending to be written for a target.
+
+        Args:
+            target_guid: the target to get bodies for.
+        """
+        return self.pending.pop(target_guid, {})
+
+    def restore(self, target_guid : str, bodies : Dict[str, bytes]) -> None:
+        """
+        Puts back bodies returned by `take` that could not be written, so that
+        they are written along with the next batch.
+
+        Args:
+            target_guid: the target the bodies belong to.
+            bodies: as returned by `take`.
+        """
+        self.pending.setdefault(target_guid, {}).update(bodies)
+
+    def write(self, conn : Any, target_guid : str, bodies : Dict[str, bytes]) -> None:
+        """
+        Inserts bodies into the target's `response_bodies` table. Bodies that
+        are already there are left untouched. Must be followed by
+        `mark_written` once the transaction has been committed.
+
+        Args:
+            conn: a session as returned by database_connect.
+            target_guid: the target the bodies belong to.
+            bodies: as returned by `take`.
+        """
+        if target_guid not in self.tables_created:
+            ResponseBody.__table__.create(conn.connection(), checkfirst=True)
+
+        values = [{"hash": h, "size": len(c), "content": c} for h, c in bodies.items()]
+        conn.execute(insert(ResponseBody.__table__).values(values).on_conflict_do_nothing())
+
+    def mark_written(self, target_guid : str, hashes : Iterable[str]) -> None:
+        """
+        Records bodies as present in the database so they are skipped next
+        time. The target's table is only recorded as created at this point, as
+        the CREATE TABLE is rolled back along with the rest of a failed
+        transaction.
+
+        Args:
+            target_guid: the target the bodies belong to.
+            hashes: the hashes of the bodies that have been committed.
+        """
+        self.tables_created.add(target_guid)
+
+        for body_hash in hashes:
+            self.seen[(target_guid, body_hash)] = True
+            self.seen.move_to_end((target_guid, body_hash))
+
+        while len(self.seen) > self.SEEN_CACHE_SIZE:
+            self.seen.popitem(last=False)
+
+def decode_body(content : bytes, encoding : Optional[str]) -> bytes:
+    """
+    Decodes a body stored with its original Content-Encoding. Bodies that
+    can't be decoded are returned as-is, the same as mitmproxy's
+    `decode(strict=False)`.
+
+    Args:
+        content: the raw body bytes.
+        encoding: the value of the Content-Encoding header, if any.
+    """
+    if not encoding:
+        return content
+
+    try:
+        decoded : bytes = mitmproxy.net.http.encoding.decode(content, encoding)
+        return decoded
+    except ValueError:
+        return content
+
+def iter_body(conn : Any, response : mitmproxy.net.http.Response, blob_store :
+        Optional[BlobStore] = None) -> Iterator[bytes]:
+    """
+    Yields the raw body for a response read back from the database in
+    chunks, resolving body references if required. Bodies in the blob store
+    are streamed from disk; other bodies are yielded in a single chunk.
+
+    Args:
+        conn: a session as returned by database_connect for the response's
+            target.
+        response: the stored response.
+        blob_store: checked first for referenced bodies, if set.
+    """
+    body_hash = response.headers.get(BODY_HASH_HEADER)
+    if body_hash is None:
+        if response.raw_content:
+            yield response.raw_content
+        return
+
+    if blob_store is not None and blob_store.exists(body_hash):
+        yield from blob_store.iter_chunks(body_hash)
+        return
+
+    stmt = select(ResponseBody.content).where(ResponseBody.hash == body_hash)
+    content : Optional[bytes] = conn.execute(stmt).scalar()
+    if content:
+        yield content
+
+def load_body(conn : Any, response : mitmproxy.net.http.Response, decode :
+        bool = False, blob_store : Optional[BlobStore] = None) -> Optional[bytes]:
+    """
+    Returns the body for a response read back from the database, resolving
+    body references if required. See `iter_body` to avoid loading large
+    bodies in memory.
+
+    Args:
+        conn: see `iter_body`.
+        response: the stored response.
+        decode: whether to undo the response's Content-Encoding. Workers
+            forward bodies still encoded, so this is required to get
+            plaintext.
+        blob_store: see `iter_body`.
+    """
+    body_hash = response.headers.get(BODY_HASH_HEADER)
+    if body_hash is None:
+        content = response.raw_content
+    elif blob_store is not None and blob_store.exists(body_hash):
+        content = b"".join(blob_store.iter_chunks(body_hash))
+    else:
+        stmt = select(ResponseBody.content).where(ResponseBody.hash == body_hash)
+        content = conn.execute(stmt).scalar()
+
+    if content is not None and decode:
+        content = decode_body(content, response.headers.get("content-encoding"))
+
+    return content
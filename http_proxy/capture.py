@@ -0,0 +1,188 @@
+from http_proxy.metrics import registry
+from http_proxy.models import Request
+from typing import IO, Any, Dict, Iterable, Iterator, NamedTuple
+import heapq
+import logging
+import mitmproxy.net.http
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_FOLDER = '/var/spool/ub-httpproxy-capture'
+
+MAGIC = b"UBCAP\x01\n"
+HEADER = struct.Struct("<dII") # timestamp, payload length, crc32 of payload.
+CAPTURE_SUFFIX = ".ubcap"
+
+class CaptureFormatException(Exception):
+    pass
+
+class CapturedRequest(NamedTuple):
+    """
+    A request read back from a capture file.
+
+    Attributes:
+        timestamp: when the request was received by the proxy.
+        body: the request serialized as http_proxy.models.Request JSON, the
+            same format that is published to the workers.
+    """
+    timestamp : float
+    body : bytes
+
+    def toMITM(self) -> mitmproxy.net.http.Request:
+        return Request.fromJSON(self.body).toMITM()
+
+class CaptureWriter(object):
+    """
+    Records the requests that pass through the addon to an append-only file
+    so that they can be replayed later with http_proxy.replay.
+
+    The request path only copies the request state into a bounded queue.
+    Serialization and disk writes happen in a background thread, and
+    requests that don't fit in the queue or past `max_bytes` are dropped and
+    counted rather than slowing the proxy down.
+
+    Each record is a HEADER followed by the payload, so a file truncated by a
+    crash can be read up to its last complete record.
+    """
+
+    MAX_QUEUED = 10000
+    MAX_BYTES = 1024 * 1024 * 1024
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, filename : str, max_bytes : int = MAX_BYTES):
+        """
+        Args:
+            filename: the capture file to create.
+            max_bytes: the capture stops once the file reaches this size.
+        """
+        self.filename = filename
+        self.max_bytes = max_bytes
+
+        self.file : IO[bytes] = open(filename, "wb")
+        self.file.write(MAGIC)
+        self.nb_bytes = len(MAGIC)
+
+        self.queue : queue.Queue = queue.Queue(maxsize=self.MAX_QUEUED)
+        self.thread = threading.Thread(target=self.run, name="capture-writer", daemon=True)
+        self.thread.start()
+
+        logger.info("Capturing requests to %s." % filename)
+
+    @classmethod
+    def open(cls, folder : str = CAPTURE_FOLDER, **kwargs : Any) -> 'CaptureWriter':
+        """
+        Creates a new capture file in `folder`, named after the current time
+        and process id so that several mitmdump instances can share a folder.
+
+        Args:
+            folder: created if it does not exist.
+            kwargs: passed on to the constructor.
+        """
+        os.makedirs(folder, exist_ok=True)
+        filename = "capture-%d-%d%s" % (time.time(), os.getpid(), CAPTURE_SUFFIX)
+
+        return cls(os.path.join(folder, filename), **kwargs)
+
+    def write(self, request : mitmproxy.net.http.Request) -> None:
+        """
+        Queues a request for capture. Safe to call from any thread and never
+        blocks.
+
+        Args:
+            request: the request as received by mitmproxy.
+        """
+        try:
+            self.queue.put_nowait((time.time(), request.get_state()))
+        except queue.Full:
+            registry.inc("capture.dropped")
+
+    def run(self) -> None:
+        flushed = time.time()
+        while True:
+            try:
+                item = self.queue.get(timeout=self.FLUSH_INTERVAL)
+            except queue.Empty:
+                item = ()
+
+            if item is None:
+                break
+
+            if item:
+                self.write_record(*item)
+
+            if self.queue.empty() or time.time() - flushed > self.FLUSH_INTERVAL:
+                self.file.flush()
+                flushed = time.time()
+
+        self.file.close()
+
+    def write_record(self, timestamp : float, state : Dict[str, Any]) -> None:
+        if self.nb_bytes >= self.max_bytes:
+            registry.inc("capture.dropped")
+            return
+
+        try:
+            payload = Request(state).toJSON().encode('utf-8')
+        except Exception:
+            logger.exception("Failed to serialize captured request.")
+            registry.inc("capture.dropped")
+            return
+
+        self.file.write(HEADER.pack(timestamp, len(payload), zlib.crc32(payload)))
+        self.file.write(payload)
+        self.nb_bytes += HEADER.size + len(payload)
+
+        registry.inc("capture.written")
+
+    def close(self) -> None:
+        """
+        Writes out the queued requests and closes the file.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+def read_capture(filename : str) -> Iterator[CapturedRequest]:
+    """
+    Reads the requests from a capture file in the order they were written.
+    A truncated or corrupt trailing record, e.g. from a proxy that crashed
+    mid-write, ends the iteration.
+
+    Args:
+        filename: a file written by CaptureWriter.
+    Raises:
+        CaptureFormatException: if the file is not a capture file.
+    """
+    with open(filename, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise CaptureFormatException("%s is not a capture file." % filename)
+
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) == 0:
+                return
+
+            if len(header) < HEADER.size:
+                logger.warning("Truncated record at the end of %s." % filename)
+                return
+
+            timestamp, length, crc = HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                logger.warning("Corrupt record at the end of %s." % filename)
+                return
+
+            yield CapturedRequest(timestamp, payload)
+
+def read_captures(filenames : Iterable[str]) -> Iterator[CapturedRequest]:
+    """
+    Merges several capture files, e.g. one per mitmdump instance, into a
+    single stream ordered by timestamp.
+    """
+    return heapq.merge(*[read_capture(filename) for filename in filenames],
+            key=lambda captured: captured.timestamp)
@@ -0,0 +1,16 @@
+from sqlalchemy import Column, Integer, LargeBinary, String
+from sqlalchemy.orm import declarative_base
+
+Base = declarative_base()
+
+class ResponseBody(Base):
+    """
+    Content-addressed storage for response bodies. RequestResponse rows whose
+    body has been moved here carry the hash in the `X-UB-Body-Hash` header of
+    the stored response instead of the body itself.
+    """
+    __tablename__ = "response_bodies"
+
+    hash = Column(String(32), primary_key=True)
+    size = Column(Integer, nullable=False)
+    content = Column(LargeBinary, nullable=False)
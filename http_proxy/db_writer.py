@@ -0,0 +1,425 @@
+from collections import OrderedDict
+from http_proxy.backoff import Backoff
+from http_proxy.body_store import BodyStore
+from http_proxy.metrics import registry
+from sqlalchemy import insert, select
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from unicornbottle.database_models import EndpointMetadata
+from unicornbottle.models import RequestResponse
+from unicornbottle.proxy import database_connect
+import datetime
+import enum
+import io
+import json
+import logging
+import psycopg2
+import sqlalchemy.exc
+import time
+
+logger = logging.getLogger(__name__)
+
+MODE_COPY = "copy"
+MODE_INSERT = "insert"
+
+# Errors caused by the rows themselves rather than by the database being
+# unavailable. Retrying the same rows can't fix them.
+PERMANENT_ERRORS = (sqlalchemy.exc.IntegrityError, sqlalchemy.exc.DataError,
+        psycopg2.IntegrityError, psycopg2.DataError)
+
+class WriteFailedException(Exception):
+    pass
+
+COPY_NULL = "\\N"
+COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+def copy_value(value : Any) -> str:
+    """
+    Encodes a python value as a field in PostgreSQL's COPY text format.
+
+    See https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.2
+
+    Args:
+        value: the value as stored in the ORM object.
+    """
+    if value is None:
+        return COPY_NULL
+
+    if isinstance(value, bool):
+        return "t" if value else "f"
+
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        text = "\\x" + bytes(value).hex()
+    elif isinstance(value, (datetime.datetime, datetime.date)):
+        text = value.isoformat()
+    elif isinstance(value, (dict, list)):
+        text = json.dumps(value)
+    elif isinstance(value, enum.Enum):
+        text = value.name
+    else:
+        text = str(value)
+
+    return text.translate(COPY_ESCAPES)
+
+def quote_identifier(name : str) -> str:
+    """
+    Quotes a possibly schema-qualified identifier for use in raw SQL.
+
+    Args:
+        name: e.g. `request_response` or `schema.request_response`.
+    """
+    return ".".join(['"%s"' % part.replace('"', '""') for part in name.split(".")])
+
+class BulkWriter(object):
+    """
+    Buffers RequestResponse rows and writes them to Postgres in bulk, either
+    through `COPY FROM STDIN` or through a single multi-row INSERT per
+    target.
+
+    A batch is due for writing once it holds `max_rows` rows or once its oldest
+    row has been waiting for `max_delay` seconds, whatever happens first.
+    EndpointMetadata ids are cached per target GUID so that repeated requests
+    to the same endpoint don't require a lookup each time.
+
+    If a BodyStore is passed in, the bodies it has collected for a target are
+    written in the same transaction as that target's rows.
+
+    If the database is unavailable, the rows that weren't written are put
+    back in the buffer and the next attempt is delayed with exponential
+    backoff. A batch rejected because of its contents is retried one row at a
+    time so that only the offending rows are dropped.
+    """
+
+    METADATA_CACHE_SIZE = 100000
+
+    def __init__(self, max_rows : int = 1000, max_delay : float = 2.0,
+            mode : str = MODE_COPY, connect : Callable = database_connect,
+            body_store : Optional[BodyStore] = None):
+        """
+        Args:
+            max_rows: number of buffered rows that trigger a write.
+            max_delay: maximum number of seconds a row can stay in the buffer.
+            mode: either MODE_COPY or MODE_INSERT.
+            connect: callable that takes a target GUID and returns a context
+                manager yielding a SQLAlchemy session.
+            body_store: optional store for deduplicated response bodies.
+        """
+        if mode not in (MODE_COPY, MODE_INSERT):
+            raise ValueError("Unknown write mode %r." % mode)
+
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.mode = mode
+        self.connect = connect
+        self.body_store = body_store
+
+        self.rows : Dict[str, List[RequestResponse]] = {}
+        self.nb_rows = 0
+        self.oldest_row : Optional[float] = None
+
+        self.metadata_ids : 'OrderedDict[Tuple[str, str], int]' = OrderedDict()
+
+        self.backoff = Backoff()
+        self.retry_at : Optional[float] = None
+
+    def add(self, target_guid : str, req_resp : RequestResponse) -> None:
+        """
+        Appends a row to the buffer.
+
+        Args:
+            target_guid: the target this row belongs to.
+            req_resp: the row to write.
+        """
+        if self.oldest_row is None:
+            self.oldest_row = time.time()
+
+        self.rows.setdefault(target_guid, []).append(req_resp)
+        self.nb_rows += 1
+
+    def due(self) -> bool:
+        """
+        Returns whether the buffered rows should be written now.
+        """
+        if self.nb_rows == 0 or self.oldest_row is None:
+            return False
+
+        if self.retry_at is not None:
+            return time.time() >= self.retry_at
+
+        if self.nb_rows >= self.max_rows:
+            return True
+
+        return time.time() - self.oldest_row >= self.max_delay
+
+    def take(self) -> Dict[str, List[RequestResponse]]:
+        """
+        Empties the buffer and returns its contents, grouped by target GUID.
+        """
+        rows = self.rows
+
+        self.rows = {}
+        self.nb_rows = 0
+        self.oldest_row = None
+
+        return rows
+
+    def requeue(self, write : Dict[str, List[RequestResponse]]) -> None:
+        """
+        Puts rows that couldn't be written back at the front of the buffer,
+        and schedules the next attempt according to the backoff.
+
+        Args:
+            write: rows grouped by target GUID, as returned by `take`.
+        """
+        for target_guid, rows in write.items():
+            self.rows[target_guid] = rows + self.rows.get(target_guid, [])
+            self.nb_rows += len(rows)
+
+        if self.oldest_row is None:
+            self.oldest_row = time.time()
+
+        self.retry_at = time.time() + self.backoff.next_delay()
+
+    def flush(self, write : Dict[str, List[RequestResponse]]) -> int:
+        """
+        Writes rows to the database. Each target is written in its own
+        transaction.
+
+        Rows rejected by the database, e.g. because of an IntegrityError, are
+        skipped. Any other error stops the flush: the rows that weren't
+        written are put back in the buffer with `requeue`, and
+        WriteFailedException is raised.
+
+        Args:
+            write: rows grouped by target GUID, as returned by `take`.
+        Returns:
+            nb_written: number of rows committed to the database.
+        Raises:
+            WriteFailedException: if the database couldn't be written to.
+        """
+        nb_written = 0
+        unwritten = dict(write)
+        for target_guid, rows in write.items():
+            bodies = self.body_store.take(target_guid) if self.body_store is not None else {}
+            nb_done = 0
+            try:
+                try:
+                    self.write_batch(target_guid, rows, bodies)
+                    nb_written += len(rows)
+                    nb_done = len(rows)
+                except PERMANENT_ERRORS:
+                    logger.warning("Batch of %s rows rejected for target %s, retrying one row at a time." %
+                            (len(rows), target_guid), exc_info=True)
+                    self.write_bodies(target_guid, bodies)
+                    bodies = {}
+
+                    for row in rows:
+                        if self.write_row(target_guid, row):
+                            nb_written += 1
+                        nb_done += 1
+            except (sqlalchemy.exc.SQLAlchemyError, psycopg2.Error) as e:
+                if self.body_store is not None and bodies:
+                    self.body_store.restore(target_guid, bodies)
+
+                unwritten[target_guid] = rows[nb_done:]
+                self.requeue(unwritten)
+
+                raise WriteFailedException("Failed to write rows for target %s." % target_guid) from e
+
+            del unwritten[target_guid]
+
+        self.backoff.reset()
+        self.retry_at = None
+
+        return nb_written
+
+    def write_batch(self, target_guid : str, rows : List[RequestResponse],
+            bodies : Dict[str, bytes]) -> None:
+        """
+        Writes rows and bodies for a single target in one transaction.
+
+        Args:
+            target_guid: the target the rows belong to.
+            rows: RequestResponse objects to write.
+            bodies: as returned by BodyStore.take.
+        """
+        created_ids : Dict[Tuple[str, str], int] = {}
+        with self.connect(target_guid) as conn:
+            if self.body_store is not None and bodies:
+                self.body_store.write(conn, target_guid, bodies)
+
+            if rows:
+                self.write_rows(conn, target_guid, rows, created_ids)
+
+            conn.commit()
+
+        self.cache_metadata_ids(created_ids)
+
+        if self.body_store is not None and bodies:
+            self.body_store.mark_written(target_guid, bodies.keys())
+
+    def write_bodies(self, target_guid : str, bodies : Dict[str, bytes]) -> None:
+        """
+        Writes bodies on their own, ahead of the rows referencing them, when a
+        batch has to be retried one row at a time. Bodies rejected by the
+        database are dropped.
+        """
+        if not bodies:
+            return
+
+        try:
+            self.write_batch(target_guid, [], bodies)
+        except PERMANENT_ERRORS:
+            logger.exception("Dropping %s bodies rejected for target %s." % (len(bodies), target_guid))
+            registry.inc("db_writer.rejected_bodies", len(bodies))
+
+    def write_row(self, target_guid : str, req_resp : RequestResponse) -> bool:
+        """
+        Writes a single row in its own transaction.
+
+        Returns:
+            written: False if the database rejected the row, in which case it
+                is dropped.
+        """
+        try:
+            self.write_batch(target_guid, [req_resp], {})
+        except PERMANENT_ERRORS:
+            logger.exception("Dropping row rejected for target %s." % target_guid)
+            registry.inc("db_writer.rejected")
+            return False
+
+        return True
+
+    def write_rows(self, conn : Any, target_guid : str, rows : List[RequestResponse],
+            created_ids : Dict[Tuple[str, str], int]) -> None:
+        """
+        Writes the rows for a single target using the configured mode.
+
+        Args:
+            conn: session as returned by `self.connect`.
+            target_guid: the target the rows belong to.
+            rows: RequestResponse objects to write.
+            created_ids: see `get_metadata_id`.
+        """
+        for req_resp in rows:
+            req_resp.metadata_id = self.get_metadata_id(conn, target_guid, req_resp, created_ids)
+
+        values = self.get_values(rows)
+        if self.mode == MODE_COPY:
+            self.copy_rows(conn, values)
+        else:
+            conn.execute(insert(RequestResponse.__table__).values(values))
+
+    def get_metadata_id(self, conn : Any, target_guid : str, req_resp :
+            RequestResponse, created_ids : Dict[Tuple[str, str], int]) -> int:
+        """
+        Returns the id of the EndpointMetadata row for this request, creating
+        it if required. Ids of existing rows are cached in a bounded LRU.
+
+        Rows created here only exist once the transaction commits, so their
+        ids are kept in `created_ids` instead and must be passed to
+        `cache_metadata_ids` after the commit. Caching them right away would
+        leave ids of rolled back rows in the cache.
+
+        Args:
+            conn: session as returned by `self.connect`.
+            target_guid: the target the row belongs to. Each target lives in
+                its own schema so ids are only unique per target.
+            req_resp: the row to find metadata for.
+            created_ids: ids created in the current transaction.
+        """
+        key = (target_guid, req_resp.pretty_url)
+        try:
+            self.metadata_ids.move_to_end(key)
+            return self.metadata_ids[key]
+        except KeyError:
+            pass
+
+        if key in created_ids:
+            return created_ids[key]
+
+        stmt = select(EndpointMetadata).where(EndpointMetadata.pretty_url == req_resp.pretty_url)
+        metadata = conn.execute(stmt).scalar()
+        if metadata is None:
+            metadata = EndpointMetadata(pretty_url=req_resp.pretty_url)
+            conn.add(metadata)
+            conn.flush()
+
+            created_ids[key] = metadata.id
+        else:
+            self.cache_metadata_ids({key: metadata.id})
+
+        metadata_id : int = metadata.id
+        return metadata_id
+
+    def cache_metadata_ids(self, ids : Dict[Tuple[str, str], int]) -> None:
+        """
+        Adds committed EndpointMetadata ids to the LRU.
+
+        Args:
+            ids: ids keyed by (target GUID, pretty_url).
+        """
+        for key, metadata_id in ids.items():
+            self.metadata_ids[key] = metadata_id
+            self.metadata_ids.move_to_end(key)
+
+        while len(self.metadata_ids) > self.METADATA_CACHE_SIZE:
+            self.metadata_ids.popitem(last=False)
+
+    def get_values(self, rows : List[RequestResponse]) -> List[Dict[str, Any]]:
+        """
+        Converts ORM objects into dictionaries of column values. Columns that
+        are unset in every row and that the database fills in on its own
+        (autoincrement primary keys, server defaults) are left out.
+
+        Args:
+            rows: RequestResponse objects to convert.
+        """
+        table = RequestResponse.__table__
+        values : List[Dict[str, Any]] = [{} for _ in rows]
+        for column in table.columns:
+            column_values = [getattr(row, column.key) for row in rows]
+            default = column.default
+            if default is not None:
+                if default.is_callable:
+                    column_values = [default.arg(None) if v is None else v for v in column_values]
+                elif default.is_scalar:
+                    column_values = [default.arg if v is None else v for v in column_values]
+
+            if all(v is None for v in column_values):
+                if column.primary_key or column.server_default is not None:
+                    continue
+
+            for row_values, value in zip(values, column_values):
+                row_values[column.name] = value
+
+        return values
+
+    def copy_rows(self, conn : Any, values : List[Dict[str, Any]]) -> None:
+        """
+        Streams rows into the RequestResponse table using `COPY FROM STDIN`
+        on the session's underlying psycopg2 connection.
+
+        Args:
+            conn: session as returned by `self.connect`.
+            values: rows as returned by `get_values`.
+        """
+        if len(values) == 0:
+            return
+
+        columns = list(values[0].keys())
+
+        buf = io.StringIO()
+        for row_values in values:
+            buf.write("\t".join([copy_value(row_values[c]) for c in columns]))
+            buf.write("\n")
+        buf.seek(0)
+
+        table = RequestResponse.__table__
+        sql = "COPY %s (%s) FROM STDIN" % (quote_identifier(table.fullname),
+                ", ".join([quote_identifier(c) for c in columns]))
+
+        cursor = conn.connection().connection.cursor()
+        try:
+            cursor.copy_expert(sql, buf)
+        finally:
+            cursor.close()
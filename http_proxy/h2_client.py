@@ -0,0 +1,263 @@
+from collections import OrderedDict
+from mitmproxy.net.http import Headers
+from typing import List, Optional, Tuple
+import h2.config
+import h2.connection
+import h2.errors
+import h2.events
+import h2.exceptions
+import mitmproxy.net.http
+import mitmproxy.net.http.status_codes
+import socket
+import time
+
+# Connection-specific headers are forbidden in HTTP/2. See RFC 7540, 8.1.2.2.
+CONNECTION_HEADERS = {b"connection", b"keep-alive", b"proxy-connection",
+        b"transfer-encoding", b"upgrade", b"host"}
+
+class H2Exception(Exception):
+    """
+    Attributes:
+        unprocessed: the server guarantees it did not process the request,
+            either by refusing the stream or by closing the connection with a
+            GOAWAY that doesn't cover it. Such a request is safe to retry
+            whatever its method. See RFC 7540, 8.1.4.
+    """
+
+    def __init__(self, message : str, unprocessed : bool = False):
+        super().__init__(message)
+        self.unprocessed = unprocessed
+
+class H2Connection(object):
+    """
+    Client side of an HTTP/2 connection to a single origin, on top of a socket
+    that negotiated `h2` through ALPN. Each request is sent on a new stream,
+    so a single connection and TLS handshake is reused for every request to
+    the origin.
+    """
+
+    READ_SIZE = 65535
+
+    def __init__(self, sock : socket.socket):
+        self.sock = sock
+
+        config = h2.config.H2Configuration(client_side=True, header_encoding=None)
+        self.conn = h2.connection.H2Connection(config=config)
+        self.conn.initiate_connection()
+        self.flush()
+
+    def flush(self) -> None:
+        data = self.conn.data_to_send()
+        if data:
+            self.sock.sendall(data)
+
+    def read_events(self) -> List[h2.events.Event]:
+        """
+        Blocks until data is received from the server and returns the
+        resulting events.
+        """
+        data = self.sock.recv(self.READ_SIZE)
+        if not data:
+            raise H2Exception("Connection closed by server.")
+
+        events : List[h2.events.Event] = self.conn.receive_data(data)
+        self.flush()
+
+        return events
+
+    def get_headers(self, request : mitmproxy.net.http.Request) -> List[Tuple[bytes, bytes]]:
+        """
+        Converts the request's HTTP/1.1 headers into HTTP/2 headers.
+
+        Args:
+            request: https://docs.mitmproxy.org/dev/api/mitmproxy/http.html
+        """
+        authority = request.data.authority or request.headers.get("host", request.host).encode("utf-8")
+        headers = [
+            (b":method", request.data.method),
+            (b":scheme", request.data.scheme),
+            (b":authority", authority),
+            (b":path", request.data.path),
+        ]
+
+        for name, value in request.headers.fields:
+            name = name.lower()
+            if name in CONNECTION_HEADERS:
+                continue
+
+            if name == b"te" and value.lower() != b"trailers":
+                continue
+
+            headers.append((name, value))
+
+        return headers
+
+    def send_body(self, stream_id : int, body : bytes) -> None:
+        """
+        Sends the request body, waiting for the server to open the flow
+        control window when required.
+        """
+        offset = 0
+        while offset < len(body):
+            window = min(self.conn.local_flow_control_window(stream_id),
+                    self.conn.max_outbound_frame_size)
+            if window <= 0:
+                for event in self.read_events():
+                    self.check_event(stream_id, event)
+                continue
+
+            chunk = body[offset:offset + window]
+            offset += len(chunk)
+            self.conn.send_data(stream_id, chunk, end_stream=offset >= len(body))
+            self.flush()
+
+    def check_event(self, stream_id : int, event : h2.events.Event) -> None:
+        if isinstance(event, h2.events.StreamReset) and event.stream_id == stream_id:
+            raise H2Exception("Stream reset by server with error code %s." % event.error_code,
+                    unprocessed=event.error_code == h2.errors.ErrorCodes.REFUSED_STREAM)
+
+        if isinstance(event, h2.events.ConnectionTerminated):
+            last_stream_id = event.last_stream_id
+            raise H2Exception("Connection terminated by server with error code %s." % event.error_code,
+                    unprocessed=last_stream_id is not None and last_stream_id < stream_id)
+
+    def request(self, request : mitmproxy.net.http.Request) -> mitmproxy.net.http.Response:
+        """
+        Sends a request on a new stream and reads the response.
+
+        Args:
+            request: https://docs.mitmproxy.org/dev/api/mitmproxy/http.html
+        Raises:
+            H2Exception: if the server resets the stream or closes the
+                connection. See its `unprocessed` attribute before retrying.
+        """
+        timestamp_start = time.time()
+        body = request.raw_content or b""
+
+        try:
+            stream_id = self.conn.get_next_available_stream_id()
+            self.conn.send_headers(stream_id, self.get_headers(request), end_stream=not body)
+            self.flush()
+
+            if body:
+                self.send_body(stream_id, body)
+
+            status_code : Optional[int] = None
+            headers : List[Tuple[bytes, bytes]] = []
+            content = []
+
+            ended = False
+            while not ended:
+                for event in self.read_events():
+                    if getattr(event, "stream_id", stream_id) != stream_id:
+                        continue
+
+                    self.check_event(stream_id, event)
+
+                    if isinstance(event, h2.events.ResponseReceived):
+                        for name, value in event.headers:
+                            if name == b":status":
+                                status_code = int(value)
+                            elif not name.startswith(b":"):
+                                headers.append((name, value))
+                    elif isinstance(event, h2.events.DataReceived):
+                        content.append(event.data)
+                        self.conn.acknowledge_received_data(event.flow_controlled_length, stream_id)
+                    elif isinstance(event, h2.events.StreamEnded):
+                        ended = True
+
+                self.flush()
+        except h2.exceptions.H2Error as e:
+            raise H2Exception("HTTP/2 protocol error: %s" % e)
+
+        if status_code is None:
+            raise H2Exception("Stream ended without a response.")
+
+        return self.to_http1(request, status_code, headers, b"".join(content), timestamp_start)
+
+    def to_http1(self, request : mitmproxy.net.http.Request, status_code : int,
+            headers : List[Tuple[bytes, bytes]], content : bytes, timestamp_start :
+            float) -> mitmproxy.net.http.Response:
+        """
+        Builds an HTTP/1.1 response out of an HTTP/2 one. The proxy talks
+        HTTP/1.1 to its clients and mitmproxy writes the response's version
+        and reason straight into the status line, so an `HTTP/2.0 200 ` status
+        line would reach clients that can't parse it.
+
+        HTTP/2 has no reason phrase, so the standard one is used. The body is
+        sent with a Content-Length, as HTTP/2 responses usually have none.
+        Trailers are dropped because they would require a chunked body.
+
+        Args:
+            request: the request the response is for.
+            status_code: the value of the `:status` pseudo-header.
+            headers: the response headers, without pseudo-headers.
+            content: the response body.
+            timestamp_start: when the request was sent.
+        """
+        if request.method.upper() != "HEAD" and status_code not in (204, 304):
+            headers = [(name, value) for name, value in headers if name.lower() != b"content-length"]
+            headers.append((b"content-length", str(len(content)).encode()))
+
+        reason = mitmproxy.net.http.status_codes.RESPONSES.get(status_code, "")
+
+        return mitmproxy.net.http.Response(
+            http_version=b"HTTP/1.1",
+            status_code=status_code,
+            reason=reason.encode(),
+            headers=Headers(headers),
+            content=content,
+            trailers=None,
+            timestamp_start=timestamp_start,
+            timestamp_end=time.time(),
+        )
+
+    @property
+    def is_open(self) -> bool:
+        return self.conn.state_machine.state != h2.connection.ConnectionState.CLOSED
+
+    def close(self) -> None:
+        try:
+            self.conn.close_connection()
+            self.flush()
+        except (h2.exceptions.H2Error, OSError):
+            pass
+        finally:
+            self.sock.close()
+
+class H2Pool(object):
+    """
+    Keeps one HTTP/2 connection open per origin so that subsequent requests
+    skip the TCP and TLS handshakes. The least recently used connection is
+    closed once MAX_CONNECTIONS is reached.
+    """
+
+    MAX_CONNECTIONS = 100
+
+    def __init__(self) -> None:
+        self.connections : 'OrderedDict[Tuple[str, int], H2Connection]' = OrderedDict()
+
+    def get(self, origin : Tuple[str, int]) -> Optional[H2Connection]:
+        conn = self.connections.get(origin)
+        if conn is None:
+            return None
+
+        if not conn.is_open:
+            self.discard(origin)
+            return None
+
+        self.connections.move_to_end(origin)
+        return conn
+
+    def put(self, origin : Tuple[str, int], conn : H2Connection) -> None:
+        self.discard(origin)
+        self.connections[origin] = conn
+
+        while len(self.connections) > self.MAX_CONNECTIONS:
+            _, evicted = self.connections.popitem(last=False)
+            evicted.close()
+
+    def discard(self, origin : Tuple[str, int]) -> None:
+        conn = self.connections.pop(origin, None)
+        if conn is not None:
+            conn.close()
@@ -0,0 +1,81 @@
+from typing import Callable, Dict
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class Registry(object):
+    """
+    Minimal in-process metrics. Counters only ever go up and are reported
+    together with their rate since the last report; gauges are callables that
+    are sampled at report time.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.counters : Dict[str, int] = {}
+        self.gauges : Dict[str, Callable[[], float]] = {}
+
+        self.last_report = time.time()
+        self.last_counters : Dict[str, int] = {}
+
+    def inc(self, name : str, value : int = 1) -> None:
+        """
+        Increments a counter, creating it if required.
+
+        Args:
+            name: the counter name, e.g. `spool.dropped`.
+            value: the amount to increment by.
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name : str, fn : Callable[[], float]) -> None:
+        """
+        Registers a gauge. Registering the same name twice replaces the
+        previous callable.
+
+        Args:
+            name: the gauge name, e.g. `spool.lag_bytes`.
+            fn: called at report time to obtain the current value.
+        """
+        with self.lock:
+            self.gauges[name] = fn
+
+    def snapshot(self) -> Dict[str, float]:
+        """
+        Returns the current value of all counters and gauges, plus a `.rate`
+        entry per counter with its increments per second since the last call.
+        """
+        with self.lock:
+            now = time.time()
+            elapsed = max(now - self.last_report, 0.001)
+
+            values : Dict[str, float] = {}
+            for name, value in self.counters.items():
+                values[name] = value
+                values[name + ".rate"] = (value - self.last_counters.get(name, 0)) / elapsed
+
+            gauges = list(self.gauges.items())
+
+            self.last_report = now
+            self.last_counters = dict(self.counters)
+
+        for name, fn in gauges:
+            try:
+                values[name] = fn()
+            except Exception:
+                logger.exception("Failed to read gauge %s." % name)
+
+        return values
+
+    def log(self) -> None:
+        """
+        Writes a snapshot to the log in a single line.
+        """
+        values = self.snapshot()
+        if values:
+            logger.info("Metrics: %s" % " ".join(["%s=%.2f" % (k, v) for k, v in sorted(values.items())]))
+
+registry = Registry()
@@ -0,0 +1,134 @@
+from http_proxy.metrics import registry
+from typing import Dict, Optional
+import asyncio
+import threading
+import time
+
+class PendingCall(object):
+    """
+    A single in-flight RPC. The requesting thread waits on `event`, which is
+    set by the RabbitMQ I/O thread as soon as the reply arrives. Requesters
+    running in an asyncio event loop await `future` instead.
+    """
+    __slots__ = ("corr_id", "deadline", "event", "body", "loop", "future")
+
+    def __init__(self, corr_id : str, deadline : float,
+            loop : Optional[asyncio.AbstractEventLoop] = None):
+        self.corr_id = corr_id
+        self.deadline = deadline
+        self.event = threading.Event()
+        self.body : Optional[bytes] = None
+
+        self.loop = loop
+        self.future : Optional[asyncio.Future] = loop.create_future() if loop is not None else None
+
+    def resolve(self, body : bytes) -> None:
+        self.body = body
+        self.event.set()
+
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.set_future_result, body)
+
+    def set_future_result(self, body : bytes) -> None:
+        """
+        Runs in the event loop. The future may already be cancelled if the
+        requester timed out.
+        """
+        if self.future is not None and not self.future.done():
+            self.future.set_result(body)
+
+    def wait(self, timeout : float) -> Optional[bytes]:
+        """
+        Blocks until the reply arrives or `timeout` seconds elapse.
+
+        Returns:
+            body: the reply body, or None on timeout.
+        """
+        self.event.wait(timeout)
+        return self.body
+
+class PendingCalls(object):
+    """
+    Table of in-flight RPCs keyed by correlation id.
+
+    Entries are removed by the requester once it is done with them, whether
+    the reply arrived or not. Replies for correlation ids that are not in the
+    table arrived after their requester gave up and are dropped instead of
+    being stored. Entries that outlive their deadline, e.g. because the
+    requesting thread died, are removed by `evict_expired`.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.calls : Dict[str, PendingCall] = {}
+
+        registry.gauge("rpc.pending", self.__len__)
+
+    def __len__(self) -> int:
+        return len(self.calls)
+
+    def register(self, corr_id : str, ttl : float,
+            loop : Optional[asyncio.AbstractEventLoop] = None) -> PendingCall:
+        """
+        Adds a call to the table. Must be called before the request is
+        published so that a fast reply can't be mistaken for a late one.
+
+        Args:
+            corr_id: the correlation id the reply will carry.
+            ttl: seconds after which the entry may be evicted.
+            loop: if set, the call gets a future bound to this loop. Must be
+                called from the loop's thread.
+        """
+        call = PendingCall(corr_id, time.monotonic() + ttl, loop)
+        with self.lock:
+            self.calls[corr_id] = call
+
+        return call
+
+    def get(self, corr_id : str) -> Optional[PendingCall]:
+        with self.lock:
+            return self.calls.get(corr_id)
+
+    def resolve(self, corr_id : str, body : bytes) -> bool:
+        """
+        Hands a reply to the waiting requester. The entry stays in the table
+        until the requester discards it, so a reply that arrives before the
+        requester starts waiting is not lost.
+
+        Returns:
+            resolved: False if nobody was waiting for this reply.
+        """
+        with self.lock:
+            call = self.calls.get(corr_id)
+
+        if call is None or call.event.is_set():
+            registry.inc("rpc.late_replies")
+            return False
+
+        call.resolve(body)
+        return True
+
+    def discard(self, corr_id : str) -> None:
+        """
+        Removes a call from the table, if still present.
+        """
+        with self.lock:
+            self.calls.pop(corr_id, None)
+
+    def evict_expired(self) -> int:
+        """
+        Removes calls whose deadline has passed.
+
+        Returns:
+            nb_evicted: the number of calls removed.
+        """
+        now = time.monotonic()
+        with self.lock:
+            expired = [corr_id for corr_id, call in self.calls.items() if call.deadline < now]
+            for corr_id in expired:
+                del self.calls[corr_id]
+
+        if expired:
+            registry.inc("rpc.evicted", len(expired))
+
+        return len(expired)
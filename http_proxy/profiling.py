@@ -0,0 +1,182 @@
+from collections import Counter
+from types import FrameType
+from typing import Dict, List, Optional
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+# `kill -USR1 <pid>` profiles CPU for SamplingProfiler.DURATION seconds.
+# `kill -USR2 <pid>` does the same and also traces memory allocations.
+PROFILE_SIGNAL = signal.SIGUSR1
+MEMORY_SIGNAL = signal.SIGUSR2
+
+class SamplingProfiler(object):
+    """
+    On-demand profiler for live processes.
+
+    A session samples the stacks of every thread at a fixed interval from a
+    background thread and writes them out in the folded format understood
+    by flamegraph.pl and speedscope, one line per distinct stack with the
+    number of samples it was seen in. Nothing runs between sessions, so an
+    idle profiler costs nothing.
+
+    Memory sessions also trace allocations with tracemalloc for their
+    duration and write out the top allocation sites.
+    """
+
+    INTERVAL = 0.005
+    DURATION = 30
+    TRACEMALLOC_FRAMES = 25
+    TOP_ALLOCATORS = 50
+
+    def __init__(self, folder : str, prefix : str):
+        """
+        Args:
+            folder: where profiles are written, e.g. one of the log folders
+                in http_proxy.log.
+            prefix: prefix for the profile filenames, e.g. `ub-worker-3`.
+        """
+        self.folder = folder
+        self.prefix = prefix
+
+        self.lock = threading.Lock()
+        self.thread : Optional[threading.Thread] = None
+        self.stopping = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, duration : float = DURATION, memory : bool = False) -> bool:
+        """
+        Starts a profiling session in the background. Safe to call from a
+        signal handler.
+
+        Args:
+            duration: length of the session in seconds.
+            memory: whether to also trace memory allocations.
+        Returns:
+            started: False if a session is already running.
+        """
+        if not self.lock.acquire(blocking=False):
+            return False
+
+        try:
+            if self.running:
+                logger.info("Profiling session already running, ignoring request.")
+                return False
+
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.run, args=(duration, memory),
+                    name="profiler", daemon=True)
+            self.thread.start()
+        finally:
+            self.lock.release()
+
+        return True
+
+    def stop(self) -> None:
+        """
+        Ends the running session early. Its profile is still written.
+        """
+        self.stopping.set()
+        thread = self.thread
+        if thread is not None:
+            thread.join()
+
+    def run(self, duration : float, memory : bool) -> None:
+        logger.info("Profiling for %s seconds%s." % (duration, " with memory tracing" if memory else ""))
+
+        if memory:
+            tracemalloc.start(self.TRACEMALLOC_FRAMES)
+
+        counts : Counter = Counter()
+        nb_samples = 0
+        end = time.monotonic() + duration
+        try:
+            while time.monotonic() < end and not self.stopping.is_set():
+                self.sample(counts)
+                nb_samples += 1
+                self.stopping.wait(self.INTERVAL)
+
+            snapshot = tracemalloc.take_snapshot() if memory else None
+        finally:
+            if memory:
+                tracemalloc.stop()
+
+        base = os.path.join(self.folder, "%s-%d-%d" % (self.prefix, os.getpid(), time.time()))
+        self.write_stacks(base + ".folded", counts)
+        logger.info("Wrote %s samples to %s.folded." % (nb_samples, base))
+
+        if snapshot is not None:
+            self.write_allocators(base + ".tracemalloc.txt", snapshot)
+            logger.info("Wrote top allocators to %s.tracemalloc.txt." % base)
+
+    def sample(self, counts : Counter) -> None:
+        """
+        Adds the current stack of every thread but the profiler's own to
+        `counts`.
+        """
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own = threading.get_ident()
+
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+
+            stack = self.folded_stack(frame)
+            counts["%s;%s" % (names.get(ident, ident), stack)] += 1
+
+    def folded_stack(self, frame : Optional[FrameType]) -> str:
+        """
+        Returns the frames of a stack from the outermost to the innermost,
+        separated by semicolons.
+        """
+        frames : List[str] = []
+        while frame is not None:
+            code = frame.f_code
+            filename = "/".join(code.co_filename.split(os.sep)[-2:])
+            frames.append("%s:%s" % (filename, code.co_name))
+            frame = frame.f_back
+
+        return ";".join(reversed(frames))
+
+    def write_stacks(self, filename : str, counts : Dict[str, int]) -> None:
+        with open(filename, "w") as f:
+            for stack, count in sorted(counts.items(), key=lambda item: -item[1]):
+                f.write("%s %d\n" % (stack.replace(" ", "_"), count))
+
+    def write_allocators(self, filename : str, snapshot : tracemalloc.Snapshot) -> None:
+        snapshot = snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ])
+
+        with open(filename, "w") as f:
+            for stat in snapshot.statistics("traceback")[:self.TOP_ALLOCATORS]:
+                f.write("%s KiB in %s blocks\n" % (stat.size // 1024, stat.count))
+                for line in stat.traceback.format():
+                    f.write("%s\n" % line)
+                f.write("\n")
+
+def install(folder : str, prefix : str) -> SamplingProfiler:
+    """
+    Creates a profiler and starts a session whenever the process receives
+    PROFILE_SIGNAL or MEMORY_SIGNAL. Must be called from the main thread.
+
+    Args:
+        folder: see SamplingProfiler.
+        prefix: see SamplingProfiler.
+    """
+    profiler = SamplingProfiler(folder, prefix)
+
+    signal.signal(PROFILE_SIGNAL, lambda signum, frame: profiler.start())
+    signal.signal(MEMORY_SIGNAL, lambda signum, frame: profiler.start(memory=True))
+
+    return profiler
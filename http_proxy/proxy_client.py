@@ -0,0 +1,422 @@
+from http_proxy import db_writer, routing
+from http_proxy.blob_store import BlobStore
+from http_proxy.body_store import BodyStore
+from http_proxy.db_writer import BulkWriter, WriteFailedException
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http_proxy.amqp_pool import ConnectionPool
+from http_proxy.metrics import registry
+from http_proxy.models import Request, Response
+from http_proxy.pending import PendingCalls
+from http_proxy.spool import Spool
+from typing import Any, Dict, List, Optional
+from unicornbottle.models import DatabaseWriteItem, RequestResponse
+from unicornbottle.proxy import HTTPProxyClient, TimeoutException
+from unicornbottle.rabbitmq import rabbitmq_connect
+import asyncio
+import logging
+import mitmproxy.net.http
+import pika
+import queue
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+class ThreadsDeadException(Exception):
+    pass
+
+class ProxyClient(HTTPProxyClient):
+    """
+    HTTPProxyClient with the proxy-specific performance features layered on
+    top. The base class is shared with the fuzzers through the unicornbottle
+    submodule, so changes that only matter to the mitmdump instances live
+    here instead.
+    """
+
+    DB_BATCH_SIZE = 1000
+    DB_BATCH_MAX_DELAY = 2.0
+    DB_WRITE_MODE = db_writer.MODE_COPY
+    DB_DEDUP_BODIES = True
+    METRICS_INTERVAL = 60
+    PENDING_EVICT_INTERVAL = 5
+    PENDING_GRACE = 1.0
+    ASYNC_WORKERS = 4
+
+    def __init__(self, is_fuzzer : bool = False, spool_folder : Optional[str] = None,
+            amqp_pool_size : int = 1, host_affinity : bool = False,
+            direct_reply_to : bool = False, blob_folder : Optional[str] = None):
+        """
+        Args:
+            is_fuzzer: see HTTPProxyClient.
+            spool_folder: if set, `db_write_queue` is replaced by a disk-backed
+                spool under this folder. See http_proxy.spool.Spool.
+            amqp_pool_size: number of RabbitMQ connections to spread requests
+                over. With the default of one, the connection opened by
+                HTTPProxyClient is used.
+            host_affinity: publish to per-origin shard queues instead of
+                `rpc_queue`, so that requests for a host tend to land on the
+                same worker. See http_proxy.routing.
+            direct_reply_to: receive replies through RabbitMQ direct
+                reply-to rather than declared reply queues. Requests are then
+                always sent through a ConnectionPool, even of size one, as
+                the connection opened by HTTPProxyClient declares its own
+                reply queue.
+            blob_folder: if set, large response bodies are stored in a
+                BlobStore under this folder instead of in Postgres. Only
+                used if DB_DEDUP_BODIES is set.
+        """
+        super().__init__(is_fuzzer)
+
+        self.host_affinity = host_affinity
+
+        self.amqp_pool : Optional[ConnectionPool] = None
+        if amqp_pool_size > 1 or direct_reply_to:
+            self.amqp_pool = ConnectionPool(amqp_pool_size, self.on_response, direct_reply_to)
+
+        self.spool : Optional[Spool] = None
+        if spool_folder is not None:
+            self.spool = Spool.open_free(spool_folder)
+            self.db_write_queue = self.spool
+
+            registry.gauge("spool.pending", self.spool.qsize)
+            registry.gauge("spool.lag_bytes", self.spool.lag_bytes)
+
+        self.metrics_logged = time.time()
+
+        self.pending = PendingCalls()
+        self.pending_evicted = time.time()
+
+        self.executor = ThreadPoolExecutor(self.ASYNC_WORKERS, thread_name_prefix="proxy-client")
+
+        self.body_store : Optional[BodyStore] = None
+        if self.DB_DEDUP_BODIES:
+            blob_store = BlobStore(blob_folder) if blob_folder is not None else None
+            self.body_store = BodyStore(blob_store)
+        self.db_writer = BulkWriter(self.DB_BATCH_SIZE, self.DB_BATCH_MAX_DELAY,
+                self.DB_WRITE_MODE, body_store=self.body_store)
+
+    def send_request(self, request : mitmproxy.net.http.Request, corr_id : str) -> mitmproxy.net.http.Response:
+        """
+        Sends a request to the workers and blocks until the reply arrives.
+
+        Same contract as HTTPProxyClient.send_request, but the call is tracked
+        in `self.pending` so that the reply wakes this thread up directly and
+        late replies are dropped rather than accumulating in `responses`.
+
+        Args:
+            request: the request as received by mitmproxy.
+            corr_id: a unique id for this request.
+        Raises:
+            ThreadsDeadException: if a thread the reply depends on has died.
+            TimeoutException: if no reply arrives within REQUEST_TIMEOUT.
+        """
+        response = None
+        exception = None
+
+        self.pending.register(corr_id, self.REQUEST_TIMEOUT + self.PENDING_GRACE)
+        try:
+            self.check_threads_alive()
+            self.publish_request(request, corr_id)
+            response = self.get_response(corr_id)
+            return response
+        except Exception as e:
+            exception = e
+            raise
+        finally:
+            self.pending.discard(corr_id)
+            self.queue_write(request, response, exception)
+
+    async def send_request_async(self, request : mitmproxy.net.http.Request,
+            corr_id : str) -> mitmproxy.net.http.Response:
+        """
+        Same as `send_request`, but awaits the reply instead of blocking a
+        thread. Must be called from the event loop the reply should be
+        delivered to.
+
+        Serializing the request and the response and queueing the database
+        write are CPU-bound, e.g. base64 and pickling of large bodies, so they
+        run in `self.executor` rather than stalling every other flow on the
+        loop.
+
+        Args:
+            request: the request as received by mitmproxy.
+            corr_id: a unique id for this request.
+        Raises:
+            ThreadsDeadException: if a thread the reply depends on has died.
+            TimeoutException: if no reply arrives within REQUEST_TIMEOUT.
+        """
+        response = None
+        exception = None
+
+        loop = asyncio.get_running_loop()
+        call = self.pending.register(corr_id, self.REQUEST_TIMEOUT + self.PENDING_GRACE, loop)
+        try:
+            self.check_threads_alive()
+            await loop.run_in_executor(self.executor, self.publish_request, request, corr_id)
+
+            assert call.future is not None
+            try:
+                body = await asyncio.wait_for(call.future, self.REQUEST_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise TimeoutException("Timed out waiting for reply to %s." % corr_id)
+
+            response = await loop.run_in_executor(self.executor, self.parse_response, body)
+            return response
+        except Exception as e:
+            exception = e
+            raise
+        finally:
+            self.pending.discard(corr_id)
+            await loop.run_in_executor(self.executor, self.queue_write, request, response, exception)
+
+    def check_threads_alive(self) -> None:
+        """
+        Fails the request right away if the I/O thread or a connection pool
+        shard is dead, as its reply would never arrive and the request would
+        otherwise wait out REQUEST_TIMEOUT.
+
+        Raises:
+            ThreadsDeadException: if `threads_alive` returns False.
+        """
+        if not self.threads_alive():
+            raise ThreadsDeadException("Proxy client threads are not alive.")
+
+    def serialize_request(self, request : mitmproxy.net.http.Request) -> str:
+        """
+        Tags the request and strips our internal headers before it leaves
+        the proxy. The original request is left untouched because it is
+        also what gets written to the database.
+
+        Args:
+            request: the request as received by mitmproxy.
+        """
+        sent = request.copy()
+        sent.headers.pop(self.UB_GUID_HEADER, None)
+        sent.headers["X-Hackerone"] = "benteveo"
+
+        body : str = Request(sent.get_state()).toJSON()
+        return body
+
+    def publish_request(self, request : mitmproxy.net.http.Request, corr_id : str) -> None:
+        """
+        Publishes the request to the queue returned by `get_routing_key`.
+        pika is not thread-safe so the publish is handed over to the
+        connection's I/O thread. If a connection pool is configured, the
+        request and its reply go through the pool's connection for this
+        corr_id instead.
+
+        Args:
+            request: the request as received by mitmproxy.
+            corr_id: a unique id for this request.
+        """
+        body = self.serialize_request(request)
+        routing_key = self.get_routing_key(request)
+        if self.amqp_pool is not None:
+            return self.amqp_pool.publish(corr_id, body, routing_key=routing_key)
+
+        properties = pika.BasicProperties(reply_to=self.callback_queue, correlation_id=corr_id)
+
+        self.rabbit_connection.add_callback_threadsafe(partial(self.channel.basic_publish,
+            exchange='', routing_key=routing_key, properties=properties, body=body))
+
+    def get_routing_key(self, request : mitmproxy.net.http.Request) -> str:
+        """
+        Returns the queue a request should be published to.
+
+        Args:
+            request: the request as received by mitmproxy.
+        """
+        if self.host_affinity:
+            return routing.routing_key_for(request.host, request.port)
+
+        return 'rpc_queue'
+
+    def get_response(self, corr_id : str) -> mitmproxy.net.http.Response:
+        """
+        Waits for the reply to a request previously registered in
+        `self.pending`.
+
+        Args:
+            corr_id: the id the request was published with.
+        Raises:
+            TimeoutException: if no reply arrives within REQUEST_TIMEOUT.
+        """
+        call = self.pending.get(corr_id)
+        body = call.wait(self.REQUEST_TIMEOUT) if call is not None else None
+        if body is None:
+            raise TimeoutException("Timed out waiting for reply to %s." % corr_id)
+
+        return self.parse_response(body)
+
+    def parse_response(self, body : bytes) -> mitmproxy.net.http.Response:
+        """
+        Converts a reply from the workers into a mitmproxy response.
+
+        Args:
+            body: the reply as published by the worker.
+        """
+        response : mitmproxy.net.http.Response = Response.fromJSON(body).toMITM()
+        return response
+
+    def on_response(self, ch : Any, method : Any, props : pika.spec.BasicProperties,
+            body : bytes) -> None:
+        """
+        Called by pika in the I/O thread when a reply arrives. Wakes up the
+        requester immediately, or drops the reply if nobody is waiting.
+        """
+        if not self.pending.resolve(props.correlation_id, body):
+            logger.debug("%s:Dropping late reply." % props.correlation_id)
+
+    def queue_write(self, request : mitmproxy.net.http.Request, response :
+            Optional[mitmproxy.net.http.Response], exception : Optional[Exception]) -> None:
+        """
+        Queues the request and its outcome for writing to the database.
+        Requests without a valid target GUID header are not written.
+        DatabaseWriteItem takes care of serialising the exception.
+
+        Args:
+            request: the request as received by mitmproxy.
+            response: the response, if one was received.
+            exception: the exception raised while handling the request, if any.
+        """
+        target_guid = request.headers.get(self.UB_GUID_HEADER)
+        try:
+            uuid.UUID(target_guid)
+        except (TypeError, ValueError):
+            return
+
+        self.db_write_queue.put(DatabaseWriteItem(request=request, response=response,
+            exception=exception, target_guid=target_guid))
+
+    def thread_postgres_read_queue(self) -> None:
+        """
+        Drains items from `db_write_queue` into the bulk writer's buffer until
+        it holds DB_BATCH_SIZE rows, and writes the buffer out once it is due
+        either by size or by age. Response bodies are swapped for content
+        addresses on the way in if DB_DEDUP_BODIES is set.
+
+        While the database is unavailable the buffer stays full of the rows
+        that failed, so new items are left in the queue, and on disk if a
+        spool is used, rather than piling up in memory.
+        """
+        for _ in range(max(self.DB_BATCH_SIZE - self.db_writer.nb_rows, 0)):
+            try:
+                dwi = self.db_write_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            # We don't want the garbage that the fuzzer generates polluting
+            # the database.
+            if self.is_fuzzer:
+                continue
+
+            if self.body_store is not None:
+                dwi = self.body_store.dedup(dwi)
+
+            self.db_writer.add(dwi.target_guid, RequestResponse.createFromDWI(dwi))
+
+        if self.db_writer.due():
+            self.thread_postgres_write(self.db_writer.take())
+
+        # Once the buffer is empty, everything read from the spool so far is
+        # either in the database or was rejected by it, so it is safe to move
+        # the checkpoint forward. Rows put back after a failed write keep the
+        # buffer non-empty until they are written.
+        if self.spool is not None and self.db_writer.nb_rows == 0:
+            self.spool.commit()
+
+        # Housekeeping for the RPC side piggybacks on this thread's loop.
+        if time.time() - self.pending_evicted >= self.PENDING_EVICT_INTERVAL:
+            self.pending.evict_expired()
+            self.pending_evicted = time.time()
+
+        if time.time() - self.metrics_logged >= self.METRICS_INTERVAL:
+            registry.log()
+            self.metrics_logged = time.time()
+
+    def threads_start(self) -> None:
+        """
+        Starts the HTTPProxyClient threads and the connection pool, if any.
+        """
+        if self.host_affinity:
+            self.declare_shard_queues()
+
+        super().threads_start()
+
+        if self.amqp_pool is not None:
+            self.amqp_pool.start()
+
+    def declare_shard_queues(self) -> None:
+        """
+        Makes sure the shard queues exist before anything is published to
+        them, as messages sent to a missing queue are silently dropped.
+        """
+        connection = rabbitmq_connect()
+        try:
+            routing.declare_shard_queues(connection.channel())
+        finally:
+            connection.close()
+
+    def threads_alive(self) -> bool:
+        alive : bool = super().threads_alive()
+        if self.amqp_pool is not None:
+            alive = alive and self.amqp_pool.alive()
+
+        return alive
+
+    def threads_shutdown(self) -> None:
+        """
+        Stops the worker threads and the connection pool, writes out the rows
+        waiting for the database and flushes the spool to disk.
+        """
+        super().threads_shutdown()
+
+        # Lets in-flight calls to queue_write finish before the final flush.
+        self.executor.shutdown(wait=True)
+        self.flush_db_writer()
+
+        if self.amqp_pool is not None:
+            self.amqp_pool.stop()
+
+        if self.spool is not None:
+            self.spool.close()
+
+    def flush_db_writer(self) -> None:
+        """
+        Writes out the rows buffered in the bulk writer, without waiting for
+        the batch to be due. Called on shutdown once the reader thread has
+        stopped, as otherwise up to DB_BATCH_SIZE rows would be lost on a
+        clean exit.
+
+        Without a spool, the in-memory queue is drained first. With a spool,
+        its backlog can be gigabytes and draining it would hold up exit, so
+        it is left on disk to be replayed on the next start. If the database
+        is unavailable, a single attempt is made.
+        """
+        if self.spool is None:
+            while not self.db_write_queue.empty() and self.db_writer.retry_at is None:
+                self.thread_postgres_read_queue()
+
+        if self.db_writer.nb_rows > 0:
+            self.thread_postgres_write(self.db_writer.take())
+
+        if self.spool is not None and self.db_writer.nb_rows == 0:
+            self.spool.commit()
+
+    def thread_postgres_write(self, write : Dict[str, List[RequestResponse]]) -> None:
+        """
+        Writes a batch of rows through the bulk writer.
+
+        Args:
+            write: rows grouped by target GUID.
+        """
+        nb_rows = sum([len(rows) for rows in write.values()])
+        try:
+            nb_written = self.db_writer.flush(write)
+        except WriteFailedException:
+            logger.exception("Failed to write to the database, %s rows will be retried." %
+                    self.db_writer.nb_rows)
+            return
+
+        logger.debug("Wrote %s out of %s rows to the database." % (nb_written, nb_rows))
@@ -0,0 +1,324 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from http_proxy.capture import CapturedRequest
+from http_proxy.models import Request
+from http_proxy.proxy_client import ProxyClient
+from http_proxy import rpc_server
+from http_proxy.rpc_server import RPCServer
+from types import SimpleNamespace
+from typing import Any, Iterable, List, Optional, Tuple
+import abc
+import json
+import logging
+import math
+import mitmproxy.net.http
+import pika
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+class StubOrigin(object):
+    """
+    Local HTTP origin that answers every request with the same response, so
+    that replays against the workers measure the workers rather than the
+    internet.
+    """
+
+    def __init__(self, body_size : int = 2048, delay : float = 0.0):
+        """
+        Args:
+            body_size: size of the response body in bytes.
+            delay: seconds to wait before answering each request.
+        """
+        body = b"x" * body_size
+
+        class Handler(BaseHTTPRequestHandler):
+            def handle_any(self) -> None:
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    self.rfile.read(length)
+
+                if delay:
+                    time.sleep(delay)
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = do_OPTIONS = handle_any
+
+            def do_HEAD(self) -> None:
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+
+            def log_message(self, format : str, *args : Any) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="stub-origin", daemon=True)
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        host, port = self.server.server_address[:2]
+        assert isinstance(host, str)
+
+        return host, port
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+class Target(abc.ABC):
+    """
+    Something to replay requests into. `prepare` runs before the replay
+    starts so that its cost is not included in the measurements.
+    """
+
+    def prepare(self, captured : CapturedRequest) -> Any:
+        return captured.toMITM()
+
+    @abc.abstractmethod
+    def send(self, prepared : Any) -> int:
+        """
+        Sends a prepared request and blocks until it completes.
+
+        Returns:
+            status_code: the status code of the response.
+        """
+
+class ClientTarget(Target):
+    """
+    Replays requests through a ProxyClient, i.e. through RabbitMQ and
+    whatever workers are listening, the same way the addon does.
+
+    Captured requests still carry their target GUID header, so it is
+    removed before sending. Otherwise ProxyClient would write every replayed
+    request to the target's database again.
+    """
+
+    def __init__(self, client : ProxyClient):
+        self.client = client
+
+    def prepare(self, captured : CapturedRequest) -> mitmproxy.net.http.Request:
+        request = captured.toMITM()
+        request.headers.pop(self.client.UB_GUID_HEADER, None)
+
+        return request
+
+    def send(self, prepared : mitmproxy.net.http.Request) -> int:
+        response = self.client.send_request(prepared, str(uuid.uuid4()))
+        status_code : int = response.status_code
+
+        return status_code
+
+class ReplyChannel(object):
+    """
+    Stands in for the pika channel passed to RPCServer.on_request and keeps
+    the reply instead of publishing it.
+    """
+
+    def __init__(self) -> None:
+        self.body : Optional[bytes] = None
+
+    def basic_publish(self, exchange : str, routing_key : str, properties :
+            pika.BasicProperties, body : bytes) -> None:
+        self.body = body
+
+    def basic_ack(self, delivery_tag : int) -> None:
+        pass
+
+class ServerTarget(Target):
+    """
+    Replays requests directly into RPCServer.on_request, without RabbitMQ.
+    RPCServer is not thread-safe, so each replay thread gets its own, set up
+    the same way as the workers started by `listen`.
+    """
+
+    def __init__(self, origin : Optional[Tuple[str, int]] = None, http2 : bool = True):
+        """
+        Args:
+            origin: if set, requests are sent to this plain HTTP origin, e.g.
+                a StubOrigin, instead of their original destination.
+            http2: passed on to RPCServer.
+        """
+        self.origin = origin
+        self.http2 = http2
+        self.local = threading.local()
+
+    def prepare(self, captured : CapturedRequest) -> bytes:
+        if self.origin is None:
+            return captured.body
+
+        request = captured.toMITM()
+        request.scheme = "http"
+        request.host, request.port = self.origin
+
+        body : bytes = Request(request.get_state()).toJSON().encode('utf-8')
+        return body
+
+    def get_server(self) -> RPCServer:
+        server = getattr(self.local, "server", None)
+        if server is None:
+            server = self.local.server = RPCServer(http2=self.http2, passthrough=rpc_server.PASSTHROUGH)
+
+        return server
+
+    def send(self, prepared : bytes) -> int:
+        channel = ReplyChannel()
+        method = SimpleNamespace(delivery_tag=0)
+        props = pika.BasicProperties(reply_to="replay", correlation_id=str(uuid.uuid4()))
+
+        self.get_server().on_request(channel, method, props, prepared) # type: ignore
+
+        assert channel.body is not None
+        status_code : int = json.loads(channel.body)['status_code']
+
+        return status_code
+
+class Report(object):
+    """
+    Outcome of a replay.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.latencies : List[float] = []
+        self.status_codes : Counter = Counter()
+        self.nb_exceptions = 0
+        self.elapsed = 0.0
+
+    def add(self, latency : float, status_code : Optional[int]) -> None:
+        with self.lock:
+            self.latencies.append(latency)
+            if status_code is None:
+                self.nb_exceptions += 1
+            else:
+                self.status_codes[status_code] += 1
+
+    @property
+    def nb_requests(self) -> int:
+        return len(self.latencies)
+
+    @property
+    def throughput(self) -> float:
+        return self.nb_requests / self.elapsed if self.elapsed > 0 else 0.0
+
+    def percentile(self, p : float) -> float:
+        """
+        Returns the latency below which `p` percent of requests completed,
+        using the nearest-rank method.
+        """
+        if not self.latencies:
+            return 0.0
+
+        latencies = sorted(self.latencies)
+        rank = max(int(math.ceil(p / 100.0 * len(latencies))), 1)
+
+        return latencies[rank - 1]
+
+    def summary(self) -> str:
+        lines = [
+            "requests=%d exceptions=%d elapsed=%.2fs throughput=%.1f requests/s" % (
+                self.nb_requests, self.nb_exceptions, self.elapsed, self.throughput),
+            "latency p50=%.1fms p90=%.1fms p99=%.1fms max=%.1fms" % (
+                self.percentile(50) * 1000, self.percentile(90) * 1000,
+                self.percentile(99) * 1000, self.percentile(100) * 1000),
+            "status codes %s" % " ".join(["%s=%s" % item for item in sorted(self.status_codes.items())]),
+        ]
+
+        return "\n".join(lines)
+
+class Replayer(object):
+    """
+    Drives captured requests into a Target.
+
+    With `rate` or `speedup` set, requests are started on a fixed schedule
+    regardless of how fast the target answers, and latency is measured from
+    the scheduled start. A target that can't keep up therefore shows up as
+    growing latency instead of silently lowering the offered load. Without
+    either, requests are sent as fast as `concurrency` allows.
+    """
+
+    def __init__(self, target : Target, concurrency : int = 64, rate :
+            Optional[float] = None, speedup : Optional[float] = None):
+        """
+        Args:
+            target: where to send the requests.
+            concurrency: maximum number of requests in flight.
+            rate: requests per second.
+            speedup: replay at this multiple of the captured timing, e.g. 2
+                replays an hour of traffic in half an hour.
+        """
+        if rate is not None and speedup is not None:
+            raise ValueError("rate and speedup are mutually exclusive.")
+
+        self.target = target
+        self.concurrency = concurrency
+        self.rate = rate
+        self.speedup = speedup
+
+    def schedule(self, captures : List[CapturedRequest]) -> List[float]:
+        """
+        Returns the start time of each request, in seconds since the start of
+        the replay.
+        """
+        if self.rate is not None:
+            return [i / self.rate for i in range(len(captures))]
+
+        if self.speedup is not None and captures:
+            first = captures[0].timestamp
+            return [(captured.timestamp - first) / self.speedup for captured in captures]
+
+        return [0.0] * len(captures)
+
+    def send(self, report : Report, prepared : Any, scheduled : float,
+            slots : Optional[threading.Semaphore]) -> None:
+        status_code = None
+        try:
+            status_code = self.target.send(prepared)
+        except Exception:
+            logger.debug("Replayed request failed.", exc_info=True)
+        finally:
+            report.add(time.perf_counter() - scheduled, status_code)
+            if slots is not None:
+                slots.release()
+
+    def run(self, captures : Iterable[CapturedRequest]) -> Report:
+        """
+        Replays `captures` and blocks until every request has completed.
+        """
+        captures = list(captures)
+        prepared = [self.target.prepare(captured) for captured in captures]
+        offsets = self.schedule(captures)
+
+        paced = self.rate is not None or self.speedup is not None
+        slots = None if paced else threading.Semaphore(self.concurrency)
+
+        report = Report()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            for request, offset in zip(prepared, offsets):
+                if slots is not None:
+                    slots.acquire()
+                    scheduled = time.perf_counter()
+                else:
+                    scheduled = start + offset
+                    delay = scheduled - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                executor.submit(self.send, report, request, scheduled, slots)
+
+        report.elapsed = time.perf_counter() - start
+
+        return report
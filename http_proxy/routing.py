@@ -0,0 +1,90 @@
+from pika.adapters.blocking_connection import BlockingChannel
+from typing import Callable, List, Tuple
+import bisect
+import hashlib
+
+NB_SHARDS = 16
+SHARD_QUEUE_PREFIX = 'rpc_queue.'
+
+# Consumer priorities. RabbitMQ only delivers to a lower priority consumer
+# when every higher priority consumer of the queue is busy or gone, which
+# gives us work stealing and rebalancing without any coordination between
+# workers. See https://www.rabbitmq.com/consumer-priority.html
+HOME_PRIORITY = 10
+STEAL_PRIORITY = 0
+
+def shard_queue(shard : int) -> str:
+    return "%s%d" % (SHARD_QUEUE_PREFIX, shard)
+
+def hash_key(key : str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+class HashRing(object):
+    """
+    Consistent hash ring mapping keys to shards. Each shard is placed on the
+    ring `replicas` times so that keys are spread evenly, and changing the
+    number of shards only moves the keys of the shards added or removed.
+    """
+
+    def __init__(self, nb_shards : int = NB_SHARDS, replicas : int = 64):
+        points : List[Tuple[int, int]] = []
+        for shard in range(nb_shards):
+            for replica in range(replicas):
+                points.append((hash_key("%s-%s" % (shard, replica)), shard))
+
+        points.sort()
+        self.hashes = [point[0] for point in points]
+        self.shards = [point[1] for point in points]
+
+    def shard_for(self, key : str) -> int:
+        """
+        Returns the shard that owns a key.
+
+        Args:
+            key: e.g. `www.example.org:443`.
+        """
+        i = bisect.bisect(self.hashes, hash_key(key)) % len(self.hashes)
+        return self.shards[i]
+
+ring = HashRing()
+
+def routing_key_for(host : str, port : int) -> str:
+    """
+    Returns the shard queue requests for an origin should be published to.
+
+    Args:
+        host: the request host, with or without a port suffix.
+        port: the request port.
+    """
+    host = host.split(':')[0]
+    return shard_queue(ring.shard_for("%s:%s" % (host, port)))
+
+def home_shards(worker_id : int, nb_shards : int = NB_SHARDS) -> List[int]:
+    """
+    Returns the shards a worker consumes at high priority. Workers are
+    started with sequential ids, so this spreads them evenly over the shards.
+    """
+    return [worker_id % nb_shards]
+
+def declare_shard_queues(channel : BlockingChannel, nb_shards : int = NB_SHARDS) -> None:
+    for shard in range(nb_shards):
+        channel.queue_declare(queue=shard_queue(shard))
+
+def consume_shards(channel : BlockingChannel, worker_id : int, callback : Callable,
+        nb_shards : int = NB_SHARDS) -> None:
+    """
+    Subscribes a worker to every shard queue: its home shards at high
+    priority and the rest at low priority, so that idle workers pick up
+    requests for shards whose home workers are busy or missing.
+
+    Args:
+        channel: the worker's channel. Its prefetch limit must be global so
+            that it applies across all the consumers.
+        worker_id: the worker's id, as passed on the command line.
+        callback: pika consumer callback.
+    """
+    home = home_shards(worker_id, nb_shards)
+    for shard in range(nb_shards):
+        priority = HOME_PRIORITY if shard in home else STEAL_PRIORITY
+        channel.basic_consume(queue=shard_queue(shard), on_message_callback=callback,
+                arguments={'x-priority': priority})
@@ -1,6 +1,11 @@
+from http_proxy.admission import AdmissionController
+from http_proxy.capture import CaptureWriter
+from http_proxy.proxy_client import ProxyClient
 from mitmproxy.script import concurrent
 from unicornbottle.database_models import STATIC_FILES
+from typing import Optional
 from unicornbottle.proxy import HTTPProxyClient
+import asyncio
 import logging
 import mitmproxy
 import time
@@ -13,10 +18,22 @@ class HTTPProxyAddon(object):
     Handles integration with mitmproxy.
     """
 
-    def __init__(self, client : HTTPProxyClient):
+    def __init__(self, client : HTTPProxyClient, admission :
+            Optional[AdmissionController] = None, capture :
+            Optional[CaptureWriter] = None):
+        """
+        Args:
+            client: the client used to send requests to the workers.
+            admission: if set, limits the number of requests in flight and
+                sheds the excess with a 503.
+            capture: if set, every request handled is recorded for replay.
+                See http_proxy.replay.
+        """
         logger.info("Mitmproxy addon started.")
 
         self.client : HTTPProxyClient = client
+        self.admission = admission
+        self.capture = capture
 
         logger.info("Established connection to RabbitMQ.")
 
@@ -27,6 +44,9 @@ class HTTPProxyAddon(object):
         logger.error("EXITING CLEANLY due to Ctrl-C.")
         self.client.threads_shutdown()
 
+        if self.capture is not None:
+            self.capture.close()
+
     def is_very_clearly_static(self, pretty_url:str) -> bool:
         """
         Returns whether we can tell that it's a static file we don't care about
@@ -42,6 +62,15 @@ class HTTPProxyAddon(object):
 
         return False
 
+    def overloaded_response(self) -> mitmproxy.http.HTTPResponse:
+        """
+        Response for requests shed by admission control. Failing fast lets
+        clients back off instead of waiting out REQUEST_TIMEOUT.
+        """
+        assert self.admission is not None
+        return mitmproxy.http.HTTPResponse.make(503, b"503 Overloaded",
+                {"Retry-After": str(self.admission.retry_after)})
+
     @concurrent # type: ignore
     def request(self, flow: mitmproxy.http.HTTPFlow) -> None:
         """
@@ -66,6 +95,13 @@ class HTTPProxyAddon(object):
             flow: the flow for this request. At this stage, flow.response is
                 not yet set, but will be set by this function.
         """
+        if self.capture is not None:
+            self.capture.write(flow.request)
+
+        if self.admission is not None and not self.admission.acquire():
+            flow.response = self.overloaded_response()
+            return
+
         try:
             time_start = time.time()
             corr_id = str(uuid.uuid4())
@@ -78,5 +114,77 @@ class HTTPProxyAddon(object):
         except:
             logger.exception("Unhandled exception in request thread.", exc_info=True)
             flow.response = mitmproxy.http.HTTPResponse.make(502, b"502 Exception")
+        finally:
+            if self.admission is not None:
+                self.admission.release()
 
+class AsyncHTTPProxyAddon(HTTPProxyAddon):
+    """
+    Variant of HTTPProxyAddon that doesn't need a thread per request.
+
+    mitmproxy 6 hooks can't be coroutines, but a hook may take the flow's
+    reply and commit it later, which is what @concurrent does from a new
+    thread. Here the hook takes the reply and schedules a coroutine on
+    mitmproxy's event loop instead, which awaits the RPC reply and commits.
+
+    This removes the thread per in-flight request, but mitmproxy 6 still
+    runs one thread per client connection, so memory still grows with the
+    number of open connections.
+    """
+
+    def __init__(self, client : ProxyClient, admission :
+            Optional[AdmissionController] = None, capture :
+            Optional[CaptureWriter] = None):
+        super().__init__(client, admission, capture)
 
+        self.client : ProxyClient = client
+
+    def request(self, flow: mitmproxy.http.HTTPFlow) -> None:
+        """
+        Main mitmproxy entry point. Runs in mitmproxy's event loop, so it
+        must not block.
+        """
+        if self.is_very_clearly_static(flow.request.pretty_url):
+            return
+
+        flow.reply.take()
+        asyncio.ensure_future(self._request_async(flow))
+
+    async def _request_async(self, flow: mitmproxy.http.HTTPFlow) -> None:
+        """
+        Same as _request, but awaits the response and hands the flow back to
+        mitmproxy when done.
+
+        Args:
+            flow: the flow for this request. Its reply must have been taken.
+        """
+        if self.capture is not None:
+            self.capture.write(flow.request)
+
+        admitted = False
+        try:
+            if self.admission is not None:
+                admitted = await self.admission.acquire_async()
+                if not admitted:
+                    flow.response = self.overloaded_response()
+                    return
+
+            time_start = time.time()
+            corr_id = str(uuid.uuid4())
+            logger.debug("%s:Started handling for url %s" % (corr_id, flow.request.pretty_url))
+
+            flow.response = await self.client.send_request_async(flow.request, corr_id)
+
+            logger.debug("%s:Done handling request. Total time %s seconds" % (corr_id, time.time() - time_start))
+        except:
+            logger.exception("Unhandled exception in request coroutine.", exc_info=True)
+            flow.response = mitmproxy.http.HTTPResponse.make(502, b"502 Exception")
+        finally:
+            if admitted:
+                assert self.admission is not None
+                self.admission.release()
+
+            if flow.reply.state == "taken":
+                if not flow.reply.has_message:
+                    flow.reply.ack()
+                flow.reply.commit()
@@ -1,10 +1,11 @@
-from http_proxy import log
+from http_proxy import log, routing
+from http_proxy.backoff import Backoff
 from http_proxy.models import Request, Response
 from mitmproxy.net.http.http1 import assemble
 from mitmproxy.net.http.http1.read import read_response_head
 from mitmproxy.net.http import http1
 from pika.adapters.blocking_connection import BlockingChannel
-from typing import Dict, Optional, Any
+from typing import TYPE_CHECKING, Dict, Optional, Any
 from unicornbottle.rabbitmq import rabbitmq_connect
 import base64
 import json
@@ -12,14 +13,25 @@ import logging
 import mitmproxy.http
 import mitmproxy.net.http
 import pika
-import random
+import pika.exceptions
 import socket
 import ssl
 import time
 
+if TYPE_CHECKING:
+    from http_proxy.h2_client import H2Connection, H2Pool
+
 logger = logging.getLogger(__name__)
 TIMEOUT = 10
 
+# Forward request bodies as received rather than decompressing them first.
+# See RPCServer.
+PASSTHROUGH = True
+
+# Methods that can be sent again after a failure without changing the outcome.
+# See RFC 7231, 4.2.2.
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "TRACE", "PUT", "DELETE"}
+
 class RPCServer(object):
     """
     Base class for server instances. Please note that this class and this
@@ -27,6 +39,31 @@ class RPCServer(object):
     required is preferred as this avoids concurrency issues due to Python's GIL.
     """
 
+    def __init__(self, http2 : bool = True, passthrough : bool = False):
+        """
+        Args:
+            http2: whether to offer HTTP/2 to HTTPS origins through ALPN.
+                Origins that don't select it are spoken to over HTTP/1.1.
+            passthrough: send request bodies to the origin exactly as
+                received, keeping their Content-Encoding, instead of decoding
+                them first. Response bodies are never decoded by the worker;
+                consumers that need plaintext decode them when reading, see
+                http_proxy.body_store.decode_body.
+        """
+        self.http2 = http2
+        self.passthrough = passthrough
+
+        # Created along with the first HTTP/2 connection, so that workers
+        # that never speak HTTP/2 don't pay for importing h2.
+        self.h2_pool : Optional['H2Pool'] = None
+
+    def get_h2_pool(self) -> 'H2Pool':
+        if self.h2_pool is None:
+            from http_proxy.h2_client import H2Pool
+            self.h2_pool = H2Pool()
+
+        return self.h2_pool
+
     def get_raw_request(self, request : mitmproxy.net.http.Request) -> bytes:
         """
         Obtains the assembled raw bytes required for sending through a socket
@@ -35,7 +72,9 @@ class RPCServer(object):
         Args:
             request: https://docs.mitmproxy.org/dev/api/mitmproxy/http.html
         """
-        request.decode(strict=False)
+        if not self.passthrough:
+            request.decode(strict=False)
+
         raw_request : bytes = assemble.assemble_request(request) # type: ignore
         
         return raw_request
@@ -67,6 +106,8 @@ class RPCServer(object):
         are hostname checking and TLS certificate verification. To add insult
         to injury, SSLv2 and SSLv3 are also enabled.
 
+        If HTTP/2 is enabled, it is offered through ALPN alongside HTTP/1.1.
+
         Args:
             request: https://docs.mitmproxy.org/dev/api/mitmproxy/http.html
 
@@ -83,6 +124,9 @@ class RPCServer(object):
             context.options &= ~ssl.OP_NO_SSLv3
             context.options &= ~ssl.OP_NO_SSLv2
 
+            if self.http2:
+                context.set_alpn_protocols(["h2", "http/1.1"])
+
             ssl_sock = context.wrap_socket(sock, server_hostname=request.host)
             return ssl_sock
         else:
@@ -93,6 +137,12 @@ class RPCServer(object):
         Main connection handler. Opens a socket, optionally wrapping with SSL
         if required and sends to destination.
 
+        If an HTTP/2 connection to the origin is already open, the request is
+        sent as a new stream on it instead. New HTTPS connections that
+        negotiate HTTP/2 are kept open for subsequent requests. If the reused
+        connection fails, the request is only sent again on a new connection
+        if it is idempotent or if the server did not process it.
+
         Args:
             request: the request as sent by the proxy. It will be assembled and
                 sent.
@@ -102,9 +152,38 @@ class RPCServer(object):
         if ':' in host:
             host = host.split(':')[0]
 
+        origin = (host, request.port)
+        h2_conn = self.h2_pool.get(origin) if self.h2_pool is not None else None
+        if h2_conn is not None:
+            from http_proxy.h2_client import H2Exception
+            try:
+                return self.send_request_h2(request, h2_conn)
+            except (H2Exception, OSError) as e:
+                self.get_h2_pool().discard(origin)
+
+                # The server may have closed the idle connection, in which
+                # case we retry once on a fresh one. Otherwise a request that
+                # reached the server could be executed twice.
+                unprocessed = isinstance(e, H2Exception) and e.unprocessed
+                if not unprocessed and request.method.upper() not in IDEMPOTENT_METHODS:
+                    raise
+
+                logger.debug("Reused HTTP/2 connection to %s:%s failed, reconnecting." % origin)
+
         # Connect to port.
         sock = self.get_socket(request)
-        sock.connect((host, request.port))
+        sock.connect(origin)
+
+        if isinstance(sock, ssl.SSLSocket) and sock.selected_alpn_protocol() == "h2":
+            from http_proxy.h2_client import H2Connection
+            h2_pool = self.get_h2_pool()
+            h2_conn = H2Connection(sock)
+            h2_pool.put(origin, h2_conn)
+            try:
+                return self.send_request_h2(request, h2_conn)
+            except:
+                h2_pool.discard(origin)
+                raise
 
         # Send bytes.
         request_bytes = self.get_raw_request(request)
@@ -114,6 +193,20 @@ class RPCServer(object):
         response = self.parse_response(request, sock)
         return response
 
+    def send_request_h2(self, request : mitmproxy.net.http.Request, conn :
+            'H2Connection') -> mitmproxy.net.http.Response:
+        """
+        Sends a request on an HTTP/2 connection.
+
+        Args:
+            request: the request as sent by the proxy.
+            conn: an open connection to the request's origin.
+        """
+        if not self.passthrough:
+            request.decode(strict=False)
+
+        return conn.request(request)
+
     def on_request(self, ch : BlockingChannel, method : Any, props :
             pika.spec.BasicProperties, body : bytes) -> None:
         """
@@ -188,41 +281,62 @@ class RPCServer(object):
             logger.info("Message response too large, returning 502.")
             self.send_error_response(ch, my_props, 502, b"Message response too large.")
 
-def listen() -> None:
-    # Add a random delay to avoid 100 workers attempting to connect to RabbitMQ
-    # at exactly the same time.
-    logger.debug("Waking up.")
-    time.sleep(random.randint(0, 10))
+def listen(worker_id : Optional[int] = None) -> None:
+    """
+    Connects to RabbitMQ and processes requests until interrupted.
 
-    channel = None
-    connection = None
-    try:
-        connection = rabbitmq_connect()
+    The first connection attempt is made right away. If it fails or the
+    connection is lost later on, e.g. because the broker restarted, the
+    worker reconnects with jittered exponential backoff instead of exiting,
+    so that a fleet of workers recovers quickly without all reconnecting at
+    the same instant.
 
-        channel = connection.channel()
+    Args:
+        worker_id: if set, the worker also consumes from the host-affinity
+            shard queues, preferring its home shards. See http_proxy.routing.
+    """
+    rpc_server = RPCServer(passthrough=PASSTHROUGH)
+    backoff = Backoff()
 
-        # A reduced prefetch is essential to prevent the propagation of timeouts. 
-        channel.basic_qos(prefetch_count=1)
-        channel.queue_declare(queue='rpc_queue')
+    while True:
+        connection = None
+        try:
+            connection = rabbitmq_connect()
 
-        rpc_server = RPCServer()
+            channel = connection.channel()
 
-        # WARNING: enabling auto_ack in this method results in prefetch_count being ignored.
-        channel.basic_consume(queue='rpc_queue', on_message_callback=rpc_server.on_request)
+            # A reduced prefetch is essential to prevent the propagation of timeouts. 
+            # It is global so that it is shared between the consumers below.
+            channel.basic_qos(prefetch_count=1, global_qos=True)
+            channel.queue_declare(queue='rpc_queue')
 
-        logger.info("HTTP Server consumer started successfully. Listening for messages.")
+            # WARNING: enabling auto_ack in this method results in prefetch_count being ignored.
+            channel.basic_consume(queue='rpc_queue', on_message_callback=rpc_server.on_request)
 
-        channel.start_consuming()
+            if worker_id is not None:
+                routing.declare_shard_queues(channel)
+                routing.consume_shards(channel, worker_id, rpc_server.on_request)
 
-    except KeyboardInterrupt:
-        logger.error("Received Ctrl + C. Shutting down...")
-    except:
-        logger.exception("Unhandled exception in server thread.", exc_info=True)
-        raise
-    finally:
-        if channel:
-            channel.stop_consuming()
+            logger.info("HTTP Server consumer started successfully. Listening for messages.")
+            backoff.reset()
 
-        if connection:
-            connection.close()
+            channel.start_consuming()
 
+        except KeyboardInterrupt:
+            logger.error("Received Ctrl + C. Shutting down...")
+            break
+        except pika.exceptions.AMQPError:
+            logger.exception("Lost connection to RabbitMQ.")
+        except:
+            logger.exception("Unhandled exception in server thread.", exc_info=True)
+            raise
+        finally:
+            if connection is not None and connection.is_open:
+                try:
+                    connection.close()
+                except pika.exceptions.AMQPError:
+                    pass
+
+        delay = backoff.next_delay()
+        logger.info("Reconnecting to RabbitMQ in %.2f seconds." % delay)
+        time.sleep(delay)
@@ -0,0 +1,415 @@
+from http_proxy.metrics import registry
+from typing import IO, Any, Dict, List, Optional, Tuple
+import fcntl
+import json
+import logging
+import mmap
+import os
+import pickle
+import queue
+import struct
+import threading
+import zlib
+
+logger = logging.getLogger(__name__)
+
+SPOOL_FOLDER = '/var/spool/ub-httpproxy'
+
+HEADER = struct.Struct("<II") # payload length, crc32 of payload.
+SEGMENT_SUFFIX = ".seg"
+CHECKPOINT_FILE = "checkpoint"
+LOCK_FILE = "lock"
+
+class SpoolFullException(Exception):
+    pass
+
+class RecordTooLargeException(SpoolFullException):
+    pass
+
+class Spool(object):
+    """
+    Disk-backed replacement for `db_write_queue`.
+
+    Items are pickled and appended to fixed-size, memory-mapped segment files
+    so that `put` is a memory copy rather than a syscall. The consumer reads
+    items in order and calls `commit` once everything it has read so far has
+    been written to the database. The committed position is persisted in a
+    checkpoint file, and anything after it is replayed when the spool is
+    opened again after a crash. Fully consumed segments are deleted on
+    commit.
+
+    Records larger than a segment, e.g. responses with very large bodies,
+    get a segment of their own sized to fit.
+
+    The spool is bounded by `quota` bytes on disk. Items that don't fit are
+    dropped and counted, the same as if Postgres had rejected them, because
+    blocking would stall the proxy.
+
+    Segments are not msynced when full. Writes to a shared mapping are in
+    the page cache as soon as they are made, so they survive the process
+    crashing, and the kernel writes them back on its own.
+
+    Spool files are trusted local state; they are unpickled on replay and
+    must only be writable by the proxy user.
+    """
+
+    SEGMENT_SIZE = 64 * 1024 * 1024
+    QUOTA = 10 * 1024 * 1024 * 1024
+
+    def __init__(self, directory : str, segment_size : int = SEGMENT_SIZE,
+            quota : int = QUOTA):
+        """
+        Args:
+            directory: folder holding the segments and checkpoint for this
+                spool. Created if it does not exist.
+            segment_size: size of each segment file in bytes.
+            quota: maximum number of bytes of segments on disk.
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.quota = quota
+
+        self.lock = threading.Lock()
+        self.lock_file : Optional[IO] = None
+        self.not_empty = threading.Condition(self.lock)
+
+        os.makedirs(directory, exist_ok=True)
+
+        self.mmaps : Dict[int, mmap.mmap] = {}
+
+        segments = self.list_segments()
+        self.committed = self.read_checkpoint(segments)
+
+        # Left behind by a crash between writing the checkpoint and deleting
+        # the segments it made obsolete.
+        for segment in segments:
+            if segment < self.committed[0]:
+                os.unlink(self.segment_path(segment))
+
+        segments = [segment for segment in segments if segment >= self.committed[0]]
+        self.disk_bytes = sum([os.path.getsize(self.segment_path(segment)) for segment in segments])
+        self.read_pos = self.committed
+
+        if len(segments) == 0:
+            segments = [self.committed[0]]
+
+        self.write_segment = segments[-1]
+        self.write_offset, _ = self.scan(self.write_segment, 0)
+
+        self.nb_pending = self.count_pending()
+        self.nb_uncommitted = 0
+
+        if self.nb_pending > 0:
+            logger.info("Replaying %s items from spool %s." % (self.nb_pending, directory))
+
+    @classmethod
+    def open_free(cls, base_directory : str, **kwargs : Any) -> 'Spool':
+        """
+        Opens the first spool under `base_directory` that isn't in use by
+        another process. This allows several mitmdump instances to share a
+        base directory, and for a restarted instance to pick up the spool of
+        one that crashed.
+
+        Args:
+            base_directory: folder containing numbered spool folders.
+            kwargs: passed on to the constructor.
+        """
+        os.makedirs(base_directory, exist_ok=True)
+
+        nb = 0
+        while True:
+            directory = os.path.join(base_directory, str(nb))
+            os.makedirs(directory, exist_ok=True)
+
+            lock_file = open(os.path.join(directory, LOCK_FILE), "w")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                nb += 1
+                continue
+
+            spool = cls(directory, **kwargs)
+            spool.lock_file = lock_file
+
+            return spool
+
+    def list_segments(self) -> List[int]:
+        """
+        Returns the numbers of the segments currently on disk, in order.
+        """
+        segments = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith(SEGMENT_SUFFIX):
+                segments.append(int(filename[:-len(SEGMENT_SUFFIX)]))
+
+        return sorted(segments)
+
+    def segment_path(self, segment : int) -> str:
+        return os.path.join(self.directory, "%020d%s" % (segment, SEGMENT_SUFFIX))
+
+    def get_mmap(self, segment : int, min_size : int = 0) -> mmap.mmap:
+        """
+        Returns the memory map for a segment, creating the segment file if it
+        doesn't exist yet.
+
+        Args:
+            segment: the segment number.
+            min_size: size of the segment if it is created and a record larger
+                than `segment_size` must fit in it.
+        """
+        if segment in self.mmaps:
+            return self.mmaps[segment]
+
+        fd = os.open(self.segment_path(segment), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            size = os.fstat(fd).st_size
+            if size < max(self.segment_size, min_size):
+                os.ftruncate(fd, max(self.segment_size, min_size))
+                self.disk_bytes += max(self.segment_size, min_size) - size
+                size = max(self.segment_size, min_size)
+
+            self.mmaps[segment] = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        return self.mmaps[segment]
+
+    def release_mmap(self, segment : int) -> None:
+        if segment in self.mmaps:
+            self.mmaps.pop(segment).close()
+
+    def read_record(self, segment : int, offset : int) -> Optional[bytes]:
+        """
+        Returns the payload of the record at this position, or None if there
+        is no valid record there.
+        """
+        buf = self.get_mmap(segment)
+        if offset + HEADER.size > len(buf):
+            return None
+
+        length, crc = HEADER.unpack_from(buf, offset)
+        start = offset + HEADER.size
+        if length == 0 or start + length > len(buf):
+            return None
+
+        payload = buf[start:start + length]
+        if zlib.crc32(payload) != crc:
+            logger.error("Corrupt record in spool segment %s at offset %s." % (segment, offset))
+            return None
+
+        return payload
+
+    def scan(self, segment : int, offset : int) -> Tuple[int, int]:
+        """
+        Walks the records in a segment starting at `offset`.
+
+        Returns:
+            (end, nb_records): the offset after the last valid record and the
+                number of records found.
+        """
+        nb_records = 0
+        while True:
+            payload = self.read_record(segment, offset)
+            if payload is None:
+                return offset, nb_records
+
+            offset += HEADER.size + len(payload)
+            nb_records += 1
+
+    def count_pending(self) -> int:
+        """
+        Counts records between the committed position and the end of the
+        spool. Only used when opening the spool.
+        """
+        nb_pending = 0
+        segment, offset = self.committed
+        while segment <= self.write_segment:
+            if os.path.exists(self.segment_path(segment)):
+                nb_pending += self.scan(segment, offset)[1]
+
+            segment += 1
+            offset = 0
+
+        return nb_pending
+
+    def read_checkpoint(self, segments : List[int]) -> Tuple[int, int]:
+        """
+        Returns the committed (segment, offset) position.
+        """
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE)) as f:
+                checkpoint = json.load(f)
+
+            return checkpoint["segment"], checkpoint["offset"]
+        except FileNotFoundError:
+            return (segments[0] if segments else 0), 0
+
+    def write_checkpoint(self) -> None:
+        """
+        Atomically persists the committed position.
+        """
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"segment": self.committed[0], "offset": self.committed[1]}, f)
+
+        os.replace(tmp_path, path)
+
+    def put(self, item : Any, block : bool = True, timeout : Optional[float] = None) -> None:
+        """
+        Appends an item to the spool. Never blocks, `block` and `timeout`
+        are accepted for compatibility with queue.Queue.
+
+        Args:
+            item: a picklable object.
+        """
+        payload = pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            self.append(payload)
+        except RecordTooLargeException:
+            registry.inc("spool.dropped_oversize")
+            logger.error("Item of %s bytes larger than the quota of spool %s, dropping it." %
+                    (len(payload), self.directory))
+        except SpoolFullException:
+            registry.inc("spool.dropped")
+            logger.error("Spool %s full, dropping item." % self.directory)
+
+    def put_nowait(self, item : Any) -> None:
+        self.put(item, block=False)
+
+    def append(self, payload : bytes) -> None:
+        """
+        Writes a single record at the end of the spool, moving on to a new
+        segment if the current one is full.
+
+        Raises:
+            RecordTooLargeException: if the record is larger than the quota.
+            SpoolFullException: if the record doesn't fit in the quota left.
+        """
+        record_size = HEADER.size + len(payload)
+        if record_size > self.quota:
+            raise RecordTooLargeException("Record of %s bytes larger than the quota." % record_size)
+
+        with self.lock:
+            if self.write_offset + record_size > len(self.get_mmap(self.write_segment)):
+                if self.disk_bytes + max(self.segment_size, record_size) > self.quota:
+                    raise SpoolFullException("Spool quota exceeded.")
+
+                if self.read_pos[0] != self.write_segment:
+                    self.release_mmap(self.write_segment)
+
+                self.write_segment += 1
+                self.write_offset = 0
+
+            buf = self.get_mmap(self.write_segment, record_size)
+            start = self.write_offset + HEADER.size
+
+            # The header is written last, so a reader never sees a length
+            # pointing at a partially written payload.
+            buf[start:start + len(payload)] = payload
+            HEADER.pack_into(buf, self.write_offset, len(payload), zlib.crc32(payload))
+
+            self.write_offset += record_size
+            self.nb_pending += 1
+            self.not_empty.notify()
+
+    def get(self, block : bool = True, timeout : Optional[float] = None) -> Any:
+        """
+        Returns the next item after the read position. Items are only removed
+        from disk once `commit` is called.
+
+        Raises:
+            queue.Empty: if there is nothing to read.
+        """
+        with self.lock:
+            while True:
+                payload = self.next_record()
+                if payload is not None:
+                    break
+
+                if not block or not self.not_empty.wait(timeout):
+                    raise queue.Empty
+
+        return pickle.loads(payload)
+
+    def get_nowait(self) -> Any:
+        return self.get(block=False)
+
+    def next_record(self) -> Optional[bytes]:
+        """
+        Advances the read position past the next record and returns its
+        payload. Must be called with the lock held.
+        """
+        while True:
+            segment, offset = self.read_pos
+            if segment == self.write_segment and offset >= self.write_offset:
+                return None
+
+            payload = self.read_record(segment, offset)
+            if payload is None:
+                # End of this segment, or corruption. Either way the rest of
+                # the segment is unreadable.
+                if segment != self.write_segment:
+                    self.release_mmap(segment)
+
+                self.read_pos = (segment + 1, 0)
+                continue
+
+            self.read_pos = (segment, offset + HEADER.size + len(payload))
+            self.nb_uncommitted += 1
+
+            return payload
+
+    def commit(self) -> None:
+        """
+        Marks everything read so far as durably handled. Segments that are
+        no longer needed are deleted.
+        """
+        with self.lock:
+            if self.read_pos == self.committed:
+                return
+
+            previous = self.committed[0]
+            self.committed = self.read_pos
+            self.nb_pending -= self.nb_uncommitted
+            self.nb_uncommitted = 0
+
+            self.write_checkpoint()
+
+            for segment in range(previous, self.committed[0]):
+                self.release_mmap(segment)
+                try:
+                    self.disk_bytes -= os.path.getsize(self.segment_path(segment))
+                    os.unlink(self.segment_path(segment))
+                except FileNotFoundError:
+                    pass
+
+    def qsize(self) -> int:
+        """
+        Number of items that have not been read yet.
+        """
+        with self.lock:
+            return self.nb_pending - self.nb_uncommitted
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def lag_bytes(self) -> int:
+        """
+        Number of bytes between the committed position and the end of the
+        spool.
+        """
+        with self.lock:
+            unused = len(self.get_mmap(self.write_segment)) - self.write_offset
+            return self.disk_bytes - self.committed[1] - unused
+
+    def close(self) -> None:
+        with self.lock:
+            for segment in list(self.mmaps.keys()):
+                self.mmaps[segment].flush()
+                self.release_mmap(segment)
+
+            if self.lock_file is not None:
+                self.lock_file.close()
+                self.lock_file = None
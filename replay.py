@@ -0,0 +1,62 @@
+"""
+Replays requests recorded by the addon's capture mode and reports throughput
+and latency. See http_proxy/replay.py.
+
+Usage:
+
+    python3 replay.py --target server capture-*.ubcap
+    python3 replay.py --target client --rate 500 capture-*.ubcap
+"""
+from http_proxy.capture import read_captures
+from http_proxy.replay import ClientTarget, Replayer, ServerTarget, StubOrigin, Target
+from http_proxy.proxy_client import ProxyClient
+import argparse
+import itertools
+import logging
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay captured requests.")
+    parser.add_argument("captures", nargs="+", help="capture files written by the addon.")
+    parser.add_argument("--target", choices=["server", "client"], default="server",
+            help="'server' calls RPCServer.on_request directly against a local stub origin, "
+            "'client' publishes through RabbitMQ to the running workers.")
+    parser.add_argument("--rate", type=float, help="requests per second.")
+    parser.add_argument("--speedup", type=float, help="multiple of the captured timing.")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--limit", type=int, help="replay at most this many requests.")
+    parser.add_argument("--body-size", type=int, default=2048, help="stub origin response size.")
+    parser.add_argument("--delay", type=float, default=0.0, help="stub origin response delay.")
+    parser.add_argument("--real-origins", action="store_true",
+            help="with --target server, send to the captured origins instead of a stub.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    captures = list(itertools.islice(read_captures(args.captures), args.limit))
+
+    origin = None
+    client = None
+    target : Target
+    if args.target == "server":
+        if not args.real_origins:
+            origin = StubOrigin(args.body_size, args.delay)
+            origin.start()
+
+        target = ServerTarget(origin.address if origin is not None else None)
+    else:
+        client = ProxyClient()
+        client.threads_start()
+        target = ClientTarget(client)
+
+    try:
+        report = Replayer(target, args.concurrency, args.rate, args.speedup).run(captures)
+        print(report.summary())
+    finally:
+        if origin is not None:
+            origin.stop()
+
+        if client is not None:
+            client.threads_shutdown()
+
+if __name__ == "__main__":
+    main()
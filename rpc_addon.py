@@ -1,12 +1,52 @@
-from http_proxy.log import Type, configure_logging
-from http_proxy.rpc_client import HTTPProxyAddon
-from unicornbottle.proxy import HTTPProxyClient
+from http_proxy import profiling, routing
+from http_proxy.admission import AdmissionController, QueueDepthMonitor
+from http_proxy.blob_store import BLOB_FOLDER
+from http_proxy.capture import CAPTURE_FOLDER, CaptureWriter
+from http_proxy.log import PROXY_LOG_FOLDER, Type, configure_logging
+from http_proxy.proxy_client import ProxyClient
+from http_proxy.rpc_client import AsyncHTTPProxyAddon
+from http_proxy.spool import SPOOL_FOLDER
+
+# Number of RabbitMQ connections each mitmdump instance spreads requests over.
+AMQP_POOL_SIZE = 4
+
+# Receive replies through RabbitMQ direct reply-to instead of declaring a
+# reply queue per connection.
+DIRECT_REPLY_TO = True
+
+# Route requests for the same host to the same workers to keep their
+# connections warm. See http_proxy/routing.py.
+HOST_AFFINITY = True
+
+# Admission control. Requests over MAX_OUTSTANDING wait up to
+# ADMISSION_MAX_WAIT seconds for a slot, and are answered with a 503 if none
+# frees up or while more than MAX_QUEUE_DEPTH messages wait for workers.
+MAX_OUTSTANDING = 2000
+ADMISSION_MAX_WAIT = 2.0
+MAX_QUEUE_DEPTH = 5000
+
+# Record requests to CAPTURE_FOLDER for replaying with replay.py.
+CAPTURE = False
 
 configure_logging(Type.PROXY)
+profiling.install(PROXY_LOG_FOLDER, "ub-httpproxy")
 
-http_proxy_client = HTTPProxyClient()
+http_proxy_client = ProxyClient(spool_folder=SPOOL_FOLDER, amqp_pool_size=AMQP_POOL_SIZE,
+        host_affinity=HOST_AFFINITY, direct_reply_to=DIRECT_REPLY_TO, blob_folder=BLOB_FOLDER)
 http_proxy_client.threads_start()
 
+admission = AdmissionController(MAX_OUTSTANDING, max_wait=ADMISSION_MAX_WAIT,
+        max_queue_depth=MAX_QUEUE_DEPTH)
+
+queues = ['rpc_queue']
+if HOST_AFFINITY:
+    queues += [routing.shard_queue(shard) for shard in range(routing.NB_SHARDS)]
+
+queue_depth_monitor = QueueDepthMonitor(admission, queues)
+queue_depth_monitor.start()
+
+capture = CaptureWriter.open(CAPTURE_FOLDER) if CAPTURE else None
+
 addons = [
-    HTTPProxyAddon(http_proxy_client)
+    AsyncHTTPProxyAddon(http_proxy_client, admission, capture)
 ]
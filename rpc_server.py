@@ -1,7 +1,9 @@
-from http_proxy import rpc_server
-from http_proxy.log import Type, configure_logging
+from http_proxy import profiling, rpc_server
+from http_proxy.log import WORKER_LOG_FOLDER, Type, configure_logging
 import sys
 
 if __name__ == "__main__":
-    configure_logging(Type.WORKER, int(sys.argv[1]))
-    rpc_server.listen()
+    worker_id = int(sys.argv[1])
+    configure_logging(Type.WORKER, worker_id)
+    profiling.install(WORKER_LOG_FOLDER, "ub-worker-%s" % worker_id)
+    rpc_server.listen(worker_id)
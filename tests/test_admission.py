@@ -0,0 +1,113 @@
+from http_proxy.admission import AdmissionController, QueueDepthMonitor
+from http_proxy.metrics import registry
+from tests.test_base import TestBase
+from unittest.mock import MagicMock, patch
+import asyncio
+import threading
+import unittest
+
+class TestAdmission(TestBase):
+    """
+    This file contains tests related to admission.py.
+    """
+    def test_limit(self):
+        controller = AdmissionController(2)
+
+        self.assertTrue(controller.acquire())
+        self.assertTrue(controller.acquire())
+        self.assertFalse(controller.acquire())
+
+        controller.release()
+        self.assertTrue(controller.acquire())
+
+    def test_shed_counted(self):
+        controller = AdmissionController(0)
+
+        before = registry.counters.get("admission.shed", 0)
+        controller.acquire()
+
+        self.assertEqual(registry.counters["admission.shed"], before + 1)
+
+    def test_wait_for_slot(self):
+        controller = AdmissionController(1, max_wait=5)
+        controller.acquire()
+
+        timer = threading.Timer(0.05, controller.release)
+        timer.start()
+
+        self.assertTrue(controller.acquire())
+        self.assertEqual(controller.outstanding, 1)
+        self.assertEqual(len(controller.waiters), 0)
+
+    def test_wait_timeout(self):
+        controller = AdmissionController(1, max_wait=0.01)
+        controller.acquire()
+
+        self.assertFalse(controller.acquire())
+        self.assertEqual(len(controller.waiters), 0)
+
+    def test_queue_depth(self):
+        controller = AdmissionController(10, max_queue_depth=100)
+        controller.queue_depth = 101
+
+        self.assertFalse(controller.acquire())
+
+        controller.queue_depth = 100
+        self.assertTrue(controller.acquire())
+
+    def test_acquire_async(self):
+        controller = AdmissionController(1, max_wait=5)
+
+        async def run():
+            self.assertTrue(await controller.acquire_async())
+
+            asyncio.get_running_loop().call_later(0.05, controller.release)
+            self.assertTrue(await controller.acquire_async())
+
+            controller.max_wait = 0.01
+            self.assertFalse(await controller.acquire_async())
+
+        asyncio.run(run())
+        self.assertEqual(len(controller.waiters), 0)
+
+    def test_acquire_async_cancelled_after_grant(self):
+        controller = AdmissionController(1, max_wait=5)
+
+        async def run():
+            self.assertTrue(await controller.acquire_async())
+
+            task = asyncio.ensure_future(controller.acquire_async())
+            await asyncio.sleep(0)
+
+            # The slot is handed over while the cancellation is pending.
+            task.cancel()
+            controller.release()
+
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(run())
+        self.assertEqual(controller.outstanding, 0)
+        self.assertEqual(len(controller.waiters), 0)
+
+    @patch("http_proxy.admission.rabbitmq_connect")
+    def test_monitor_survives_exceptions(self, rabbitmq_connect):
+        controller = AdmissionController(1)
+        monitor = QueueDepthMonitor(controller, ["rpc_queue"])
+        monitor.stopping = MagicMock()
+        monitor.stopping.is_set.side_effect = [False, False, True]
+
+        broken = self._mockConnection()
+        broken.channel.return_value.queue_declare.side_effect = RuntimeError("boom")
+        working = self._mockConnection()
+        working.channel.return_value.queue_declare.return_value.method.message_count = 7
+        rabbitmq_connect.side_effect = [broken, working]
+
+        monitor.run()
+
+        self.assertEqual(controller.queue_depth, 7)
+        self.assertEqual(broken.close.call_count, 1)
+        self.assertEqual(working.close.call_count, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+from http_proxy.amqp_pool import DIRECT_REPLY_TO, ConnectionPool, Shard, ShardNotReadyException
+from http_proxy.proxy_client import ProxyClient
+from tests.test_base import TestBase
+from unittest.mock import MagicMock, patch
+import unittest
+import uuid
+
+class TestAMQPPool(TestBase):
+    """
+    This file contains tests related to amqp_pool.py.
+    """
+    def _pool(self, size):
+        pool = ConnectionPool(size, MagicMock())
+        for shard in pool.shards:
+            shard.connection = self._mockConnection()
+            shard.channel = self._mockChannel()
+            shard.callback_queue = "callback-%s" % shard.nb
+            shard.ready.set()
+
+        return pool
+
+    def test_shard_for(self):
+        pool = self._pool(4)
+        corr_ids = [str(uuid.uuid4()) for _ in range(100)]
+
+        shards = [pool.shard_for(corr_id) for corr_id in corr_ids]
+
+        self.assertEqual(shards, [pool.shard_for(corr_id) for corr_id in corr_ids])
+        self.assertEqual(len(set([shard.nb for shard in shards])), 4)
+
+    def test_publish(self):
+        pool = self._pool(4)
+        corr_id = str(uuid.uuid4())
+        shard = pool.shard_for(corr_id)
+
+        pool.publish(corr_id, "body")
+
+        self.assertEqual(shard.connection.add_callback_threadsafe.call_count, 1)
+        callback = shard.connection.add_callback_threadsafe.call_args.args[0]
+        self.assertEqual(callback.func, shard.channel.basic_publish)
+        self.assertEqual(callback.keywords['properties'].reply_to, shard.callback_queue)
+        self.assertEqual(callback.keywords['properties'].correlation_id, corr_id)
+
+    def test_publish_not_ready(self):
+        pool = self._pool(1)
+        pool.shards[0].ready.clear()
+
+        with self.assertRaises(ShardNotReadyException):
+            pool.publish(str(uuid.uuid4()), "body")
+
+    def test_proxy_client_uses_pool(self):
+        pc = self._pcWithMockedConn()
+        pc.amqp_pool = self._pool(2)
+
+        corr_id = str(uuid.uuid4())
+        pc.publish_request(self._req().toMITM(), corr_id)
+
+        self.assertEqual(pc.rabbit_connection.add_callback_threadsafe.call_count, 0)
+        self.assertEqual(pc.amqp_pool.shard_for(corr_id).connection.add_callback_threadsafe.call_count, 1)
+
+    def test_run_survives_exceptions(self):
+        shard = Shard(0, MagicMock())
+        shard.RECONNECT_DELAY = 0
+        connection = shard.connection = self._mockConnection()
+
+        def stop():
+            shard.stopping = True
+
+        shard.connect = MagicMock(side_effect=[RuntimeError("boom"), None])
+        shard.channel = MagicMock()
+        shard.channel.start_consuming.side_effect = stop
+
+        shard.run()
+
+        self.assertEqual(shard.connect.call_count, 2)
+        self.assertEqual(connection.close.call_count, 1)
+
+    @patch("http_proxy.amqp_pool.rabbitmq_connect")
+    def test_connect_reply_queue(self, rabbitmq_connect):
+        shard = Shard(0, MagicMock())
+        shard.connect()
+
+        channel = rabbitmq_connect.return_value.channel.return_value
+        self.assertEqual(channel.queue_declare.call_count, 1)
+        self.assertEqual(shard.callback_queue, channel.queue_declare.return_value.method.queue)
+
+    @patch("http_proxy.amqp_pool.rabbitmq_connect")
+    def test_connect_direct_reply_to(self, rabbitmq_connect):
+        shard = Shard(0, MagicMock(), direct_reply_to=True)
+        shard.connect()
+
+        channel = rabbitmq_connect.return_value.channel.return_value
+        self.assertEqual(channel.queue_declare.call_count, 0)
+        self.assertEqual(channel.basic_consume.call_args.kwargs['queue'], DIRECT_REPLY_TO)
+        self.assertTrue(channel.basic_consume.call_args.kwargs['auto_ack'])
+
+        shard.ready.set()
+        shard.publish('rpc_queue', str(uuid.uuid4()), "body")
+
+        callback = shard.connection.add_callback_threadsafe.call_args.args[0]
+        self.assertEqual(callback.func, channel.basic_publish)
+        self.assertEqual(callback.keywords['properties'].reply_to, DIRECT_REPLY_TO)
+
+    def test_proxy_client_direct_reply_to(self):
+        self.assertIsNone(ProxyClient().amqp_pool)
+
+        pc = ProxyClient(direct_reply_to=True)
+        self.assertEqual(len(pc.amqp_pool.shards), 1)
+        self.assertTrue(pc.amqp_pool.shards[0].direct_reply_to)
+
+if __name__ == '__main__':
+    unittest.main()
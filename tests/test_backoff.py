@@ -0,0 +1,33 @@
+from http_proxy.backoff import Backoff
+import unittest
+
+class TestBackoff(unittest.TestCase):
+    """
+    This file contains tests related to backoff.py.
+    """
+    def test_bounds(self):
+        backoff = Backoff(base=1, cap=10)
+        for attempt in range(20):
+            delay = backoff.next_delay()
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, min(10, 2 ** attempt))
+
+    def test_grows(self):
+        backoff = Backoff(base=1, cap=1000)
+        for _ in range(8):
+            backoff.next_delay()
+
+        delays = [Backoff(base=1, cap=1000).next_delay() for _ in range(100)]
+        self.assertTrue(all([delay <= 1 for delay in delays]))
+        self.assertGreater(max([backoff.next_delay() for _ in range(100)]), 1)
+
+    def test_reset(self):
+        backoff = Backoff(base=1, cap=1000)
+        for _ in range(8):
+            backoff.next_delay()
+
+        backoff.reset()
+        self.assertLessEqual(backoff.next_delay(), 1)
+
+if __name__ == '__main__':
+    unittest.main()
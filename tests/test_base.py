@@ -1,4 +1,5 @@
 from http_proxy.models import Response, Request
+from http_proxy.proxy_client import ProxyClient
 from http_proxy.rpc_client import HTTPProxyAddon
 from unicornbottle.proxy import HTTPProxyClient, TimeoutException
 from http_proxy.rpc_server import RPCServer
@@ -119,6 +120,16 @@ OK"""
 
         return hpc
 
+    def _pcWithMockedConn(self, is_fuzzer=False):
+        pc = ProxyClient(is_fuzzer)
+        pc.rabbit_connection = self._mockConnection()
+        pc.channel = self._mockChannel()
+        pc.callback_queue = self._mockQueue()
+
+        pc.threads_alive = MagicMock(return_value=True)
+
+        return pc
+
     def _dwi(self):
         dwi = DatabaseWriteItem(request=self._req().toMITM(),
                 response=self._resp().toMITM(), exception=None, target_guid=self.TEST_GUID)
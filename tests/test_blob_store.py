@@ -0,0 +1,53 @@
+from http_proxy.blob_store import BlobStore
+from http_proxy.body_store import hash_body
+import os
+import tempfile
+import unittest
+
+class TestBlobStore(unittest.TestCase):
+    """
+    This file contains tests related to blob_store.py.
+    """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = BlobStore(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_put_read(self):
+        content = os.urandom(10000)
+        body_hash = hash_body(content)
+
+        self.assertFalse(self.store.exists(body_hash))
+        self.store.put(body_hash, content)
+        self.assertTrue(self.store.exists(body_hash))
+
+        chunks = list(self.store.iter_chunks(body_hash, chunk_size=4096))
+        self.assertEqual([len(chunk) for chunk in chunks], [4096, 4096, 1808])
+        self.assertEqual(b"".join(chunks), content)
+
+    def test_layout(self):
+        body_hash = hash_body(b"content")
+        self.store.put(body_hash, b"content")
+
+        directory = os.path.join(self.tmp.name, body_hash[0:2], body_hash[2:4])
+        self.assertEqual(os.listdir(directory), [body_hash])
+
+    def test_put_existing(self):
+        body_hash = hash_body(b"content")
+        self.store.put(body_hash, b"content")
+        self.store.put(body_hash, b"content")
+
+        self.assertEqual(b"".join(self.store.iter_chunks(body_hash)), b"content")
+
+    def test_missing(self):
+        with self.assertRaises(FileNotFoundError):
+            list(self.store.iter_chunks(hash_body(b"missing")))
+
+    def test_invalid_hash(self):
+        with self.assertRaises(ValueError):
+            self.store.path("../../etc/passwd")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+from http_proxy.blob_store import BlobStore
+from http_proxy.body_store import BODY_HASH_HEADER, BodyStore, decode_body, hash_body, iter_body, load_body
+from http_proxy.db_writer import BulkWriter, WriteFailedException
+from tests.test_base import TestBase
+from unicornbottle.models import RequestResponse
+from unittest.mock import MagicMock
+import gzip
+import sqlalchemy.exc
+import tempfile
+import unittest
+
+class TestBodyStore(TestBase):
+    """
+    This file contains tests related to body_store.py.
+    """
+    def test_dedup(self):
+        store = BodyStore()
+        dwi = self._dwi()
+        original = dwi.response
+
+        dwi = store.dedup(dwi)
+
+        body_hash = hash_body(self.EXAMPLE_RESP['content'])
+        self.assertEqual(dwi.response.headers[BODY_HASH_HEADER], body_hash)
+        self.assertEqual(dwi.response.raw_content, b"")
+        self.assertEqual(store.take(self.TEST_GUID), {body_hash: self.EXAMPLE_RESP['content']})
+
+        # The response sent back to the client must not be modified.
+        self.assertEqual(original.raw_content, self.EXAMPLE_RESP['content'])
+        assert BODY_HASH_HEADER not in original.headers
+
+    def test_dedup_small_body(self):
+        store = BodyStore()
+        resp = self._resp()
+        resp.state['content'] = b"OK"
+        dwi = self._dwi()
+        dwi.response = resp.toMITM()
+
+        dwi = store.dedup(dwi)
+
+        self.assertEqual(dwi.response.raw_content, b"OK")
+        self.assertEqual(store.take(self.TEST_GUID), {})
+
+    def test_dedup_skips_written(self):
+        store = BodyStore()
+        body_hash = hash_body(self.EXAMPLE_RESP['content'])
+        store.mark_written(self.TEST_GUID, [body_hash])
+
+        dwi = store.dedup(self._dwi())
+
+        self.assertEqual(dwi.response.headers[BODY_HASH_HEADER], body_hash)
+        self.assertEqual(store.take(self.TEST_GUID), {})
+
+    def test_flush_writes_bodies(self):
+        store = BodyStore()
+        conn = MagicMock()
+        connect = MagicMock()
+        connect.return_value.__enter__.return_value = conn
+        writer = BulkWriter(connect=connect, body_store=store)
+
+        dwi = store.dedup(self._dwi())
+        writer.flush({self.TEST_GUID: [RequestResponse.createFromDWI(dwi)]})
+
+        body_hash = hash_body(self.EXAMPLE_RESP['content'])
+        assert store.was_written(self.TEST_GUID, body_hash)
+        self.assertEqual(conn.commit.call_count, 1)
+
+    def test_flush_failed_not_written(self):
+        store = BodyStore()
+        conn = MagicMock()
+        conn.commit.side_effect = sqlalchemy.exc.OperationalError("COMMIT", {}, Exception())
+        connect = MagicMock()
+        connect.return_value.__enter__.return_value = conn
+        writer = BulkWriter(connect=connect, body_store=store)
+
+        dwi = store.dedup(self._dwi())
+        with self.assertRaises(WriteFailedException):
+            writer.flush({self.TEST_GUID: [RequestResponse.createFromDWI(dwi)]})
+
+        body_hash = hash_body(self.EXAMPLE_RESP['content'])
+        assert not store.was_written(self.TEST_GUID, body_hash)
+        assert self.TEST_GUID not in store.tables_created
+
+        # Kept for the retry.
+        self.assertEqual(store.take(self.TEST_GUID), {body_hash: self.EXAMPLE_RESP['content']})
+
+    def test_load_body(self):
+        conn = MagicMock()
+        dwi = BodyStore().dedup(self._dwi())
+
+        self.assertEqual(load_body(conn, dwi.response), conn.execute().scalar.return_value)
+        self.assertEqual(load_body(conn, self._resp().toMITM()), self.EXAMPLE_RESP['content'])
+
+    def _largeDWI(self):
+        resp = self._resp()
+        resp.state['content'] = b"x" * BodyStore.BLOB_MIN_SIZE
+        dwi = self._dwi()
+        dwi.response = resp.toMITM()
+
+        return dwi
+
+    def test_dedup_blob(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            blob_store = BlobStore(tmp)
+            store = BodyStore(blob_store)
+
+            dwi = store.dedup(self._largeDWI())
+
+            body_hash = dwi.response.headers[BODY_HASH_HEADER]
+            self.assertEqual(dwi.response.raw_content, b"")
+            self.assertTrue(blob_store.exists(body_hash))
+            self.assertEqual(store.take(self.TEST_GUID), {})
+
+            # Small bodies still go to Postgres.
+            store.dedup(self._dwi())
+            self.assertEqual(len(store.take(self.TEST_GUID)), 1)
+
+    def test_dedup_blob_failed(self):
+        blob_store = MagicMock(spec=BlobStore)
+        blob_store.put.side_effect = OSError(28, "No space left on device")
+        store = BodyStore(blob_store)
+
+        dwi = store.dedup(self._largeDWI())
+
+        body_hash = dwi.response.headers[BODY_HASH_HEADER]
+        self.assertEqual(dwi.response.raw_content, b"")
+        self.assertEqual(list(store.take(self.TEST_GUID).keys()), [body_hash])
+
+    def test_load_body_blob(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            blob_store = BlobStore(tmp)
+            dwi = BodyStore(blob_store).dedup(self._largeDWI())
+            conn = MagicMock()
+
+            content = b"x" * BodyStore.BLOB_MIN_SIZE
+            self.assertEqual(load_body(conn, dwi.response, blob_store=blob_store), content)
+            self.assertEqual(b"".join(iter_body(conn, dwi.response, blob_store)), content)
+            self.assertEqual(conn.execute.call_count, 0)
+
+    def test_load_body_decode(self):
+        response = self._resp().toMITM()
+        response.headers["content-encoding"] = "gzip"
+        response.raw_content = gzip.compress(b"plaintext body")
+
+        self.assertEqual(load_body(MagicMock(), response), response.raw_content)
+        self.assertEqual(load_body(MagicMock(), response, decode=True), b"plaintext body")
+
+    def test_decode_body_invalid(self):
+        self.assertEqual(decode_body(b"not gzip", "gzip"), b"not gzip")
+        self.assertEqual(decode_body(b"plain", None), b"plain")
+
+if __name__ == '__main__':
+    unittest.main()
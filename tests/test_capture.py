@@ -0,0 +1,67 @@
+from http_proxy.capture import CaptureFormatException, CaptureWriter, read_capture, read_captures
+from tests.test_base import TestBase
+import os
+import tempfile
+import unittest
+
+class TestCapture(TestBase):
+    """
+    This file contains tests related to capture.py.
+    """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _capture(self, nb, **kwargs):
+        writer = CaptureWriter.open(self.tmp.name, **kwargs)
+        for _ in range(nb):
+            writer.write(self._req().toMITM())
+        writer.close()
+
+        return writer.filename
+
+    def test_round_trip(self):
+        filename = self._capture(3)
+
+        captures = list(read_capture(filename))
+
+        self.assertEqual(len(captures), 3)
+        request = captures[0].toMITM()
+        self.assertEqual(request.host, "www.testing.local")
+        self.assertEqual(request.path, "/testpath")
+        self.assertLessEqual(captures[0].timestamp, captures[2].timestamp)
+
+    def test_truncated(self):
+        filename = self._capture(2)
+        size = os.path.getsize(filename)
+        with open(filename, "r+b") as f:
+            f.truncate(size - 5)
+
+        self.assertEqual(len(list(read_capture(filename))), 1)
+
+    def test_max_bytes(self):
+        filename = self._capture(3, max_bytes=1)
+
+        self.assertEqual(len(list(read_capture(filename))), 0)
+
+    def test_not_a_capture(self):
+        filename = os.path.join(self.tmp.name, "other")
+        with open(filename, "wb") as f:
+            f.write(b"GET / HTTP/1.1\r\n")
+
+        with self.assertRaises(CaptureFormatException):
+            list(read_capture(filename))
+
+    def test_merge(self):
+        first = self._capture(2)
+        second = self._capture(2)
+
+        captures = list(read_captures([first, second]))
+
+        self.assertEqual(len(captures), 4)
+        self.assertEqual(captures, sorted(captures, key=lambda c: c.timestamp))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,229 @@
+from http_proxy import db_writer
+from http_proxy.db_writer import BulkWriter, WriteFailedException, copy_value
+from http_proxy.proxy_client import ProxyClient
+from http_proxy.spool import Spool
+from tests.test_base import TestBase
+from unicornbottle.models import RequestResponse
+from unittest.mock import MagicMock
+import queue
+import sqlalchemy.exc
+import tempfile
+import time
+import unittest
+
+class TestDBWriter(TestBase):
+    """
+    This file contains tests related to db_writer.py and the way ProxyClient
+    uses it.
+    """
+    def _writer(self, **kwargs):
+        conn = MagicMock()
+        connect = MagicMock()
+        connect.return_value.__enter__.return_value = conn
+
+        return BulkWriter(connect=connect, **kwargs), connect, conn
+
+    def test_copy_value(self):
+        self.assertEqual(copy_value(None), "\\N")
+        self.assertEqual(copy_value(True), "t")
+        self.assertEqual(copy_value(404), "404")
+        self.assertEqual(copy_value("a\tb\nc\\"), "a\\tb\\nc\\\\")
+        self.assertEqual(copy_value(b"\x00\xff"), "\\\\x00ff")
+
+    def test_due_by_size(self):
+        writer, _, _ = self._writer(max_rows=2, max_delay=1000)
+        rr = RequestResponse.createFromDWI(self._dwi())
+
+        writer.add(self.TEST_GUID, rr)
+        self.assertFalse(writer.due())
+
+        writer.add(self.TEST_GUID, rr)
+        self.assertTrue(writer.due())
+
+        write = writer.take()
+        self.assertEqual(len(write[self.TEST_GUID]), 2)
+        self.assertFalse(writer.due())
+
+    def test_due_by_age(self):
+        writer, _, _ = self._writer(max_rows=1000, max_delay=0.01)
+        self.assertFalse(writer.due())
+
+        writer.add(self.TEST_GUID, RequestResponse.createFromDWI(self._dwi()))
+        time.sleep(0.02)
+
+        self.assertTrue(writer.due())
+
+    def test_flush_copy(self):
+        writer, connect, conn = self._writer()
+        cursor = conn.connection().connection.cursor()
+        write = {self.TEST_GUID: [RequestResponse.createFromDWI(self._dwi()) for _ in range(10)]}
+
+        nb_written = writer.flush(write)
+
+        self.assertEqual(nb_written, 10)
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual(conn.commit.call_count, 1)
+        self.assertEqual(cursor.copy_expert.call_count, 1)
+
+        sql, buf = cursor.copy_expert.call_args.args
+        assert sql.startswith("COPY ")
+        self.assertEqual(len(buf.getvalue().splitlines()), 10)
+
+    def test_flush_insert(self):
+        writer, connect, conn = self._writer(mode=db_writer.MODE_INSERT)
+        write = {self.TEST_GUID: [RequestResponse.createFromDWI(self._dwi())]}
+
+        writer.flush(write)
+
+        self.assertEqual(conn.connection().connection.cursor().copy_expert.call_count, 0)
+        self.assertEqual(conn.commit.call_count, 1)
+
+    def test_metadata_cached(self):
+        writer, connect, conn = self._writer()
+        write = {self.TEST_GUID: [RequestResponse.createFromDWI(self._dwi()) for _ in range(10)]}
+
+        writer.flush(write)
+        writer.flush(write)
+
+        # One lookup for the metadata, the rest are served from the cache.
+        self.assertEqual(conn.execute.call_count, 1)
+        self.assertEqual(write[self.TEST_GUID][0].metadata_id, conn.execute().scalar.return_value.id)
+
+    def test_metadata_not_cached_on_rollback(self):
+        writer, connect, conn = self._writer()
+        conn.execute().scalar.return_value = None
+        conn.commit.side_effect = sqlalchemy.exc.OperationalError("COMMIT", {}, Exception())
+        write = {self.TEST_GUID: [RequestResponse.createFromDWI(self._dwi())]}
+
+        with self.assertRaises(WriteFailedException):
+            writer.flush(write)
+        self.assertEqual(len(writer.metadata_ids), 0)
+
+        conn.commit.side_effect = None
+        writer.flush(write)
+        self.assertEqual(len(writer.metadata_ids), 1)
+
+    def test_flush_failed_requeues(self):
+        writer, connect, conn = self._writer()
+        connect.side_effect = sqlalchemy.exc.OperationalError("CONNECT", {}, Exception())
+        writer.add(self.TEST_GUID, RequestResponse.createFromDWI(self._dwi()))
+
+        with self.assertRaises(WriteFailedException):
+            writer.flush(writer.take())
+
+        self.assertEqual(writer.nb_rows, 1)
+        assert not writer.due()
+
+        writer.retry_at = 0
+        assert writer.due()
+
+        connect.side_effect = None
+        self.assertEqual(writer.flush(writer.take()), 1)
+        self.assertIsNone(writer.retry_at)
+
+    def test_flush_skips_rejected_rows(self):
+        writer, connect, conn = self._writer()
+        rejected = sqlalchemy.exc.IntegrityError("COPY", {}, Exception())
+        conn.commit.side_effect = [rejected, None, rejected, None]
+        write = {self.TEST_GUID: [RequestResponse.createFromDWI(self._dwi()) for _ in range(3)]}
+
+        self.assertEqual(writer.flush(write), 2)
+        self.assertEqual(conn.commit.call_count, 4)
+        self.assertEqual(writer.nb_rows, 0)
+
+    def test_write_failed_keeps_spool(self):
+        with tempfile.TemporaryDirectory() as directory:
+            pc = self._pcWithMockedConn()
+            pc.spool = pc.db_write_queue = Spool(directory, segment_size=1024 * 1024)
+            pc.db_writer.max_delay = 0
+            connect = pc.db_writer.connect = MagicMock()
+            connect.side_effect = sqlalchemy.exc.OperationalError("CONNECT", {}, Exception())
+
+            pc.db_write_queue.put(self._dwi())
+            pc.thread_postgres_read_queue()
+            pc.spool.close()
+
+            self.assertEqual(Spool(directory).qsize(), 1)
+
+            pc.spool = pc.db_write_queue = Spool(directory)
+            pc.db_writer.take()
+            pc.db_writer.retry_at = None
+            connect.side_effect = None
+
+            pc.thread_postgres_read_queue()
+            pc.spool.close()
+
+            self.assertEqual(Spool(directory).qsize(), 0)
+
+    def test_shutdown_flushes(self):
+        pc = self._pcWithMockedConn()
+        pc.db_writer.max_delay = 1000
+        pc.thread_postgres_write = MagicMock(spec=ProxyClient.thread_postgres_write)
+
+        pc.db_write_queue.put(self._dwi())
+        pc.thread_postgres_read_queue()
+        pc.db_write_queue.put(self._dwi())
+        self.assertEqual(pc.thread_postgres_write.call_count, 0)
+
+        pc.flush_db_writer()
+
+        self.assertEqual(pc.thread_postgres_write.call_count, 1)
+        self.assertEqual(len(pc.thread_postgres_write.call_args.args[0][self.TEST_GUID]), 2)
+
+    def test_shutdown_leaves_spool_backlog(self):
+        with tempfile.TemporaryDirectory() as directory:
+            pc = self._pcWithMockedConn()
+            pc.spool = pc.db_write_queue = Spool(directory, segment_size=1024 * 1024)
+            pc.db_writer.max_delay = 1000
+            pc.thread_postgres_write = MagicMock(spec=ProxyClient.thread_postgres_write)
+
+            pc.db_write_queue.put(self._dwi())
+            pc.thread_postgres_read_queue()
+            pc.db_write_queue.put(self._dwi())
+
+            pc.flush_db_writer()
+            pc.spool.close()
+
+            self.assertEqual(len(pc.thread_postgres_write.call_args.args[0][self.TEST_GUID]), 1)
+            self.assertEqual(Spool(directory).qsize(), 1)
+
+    def test_read_queue_batches(self):
+        pc = self._pcWithMockedConn()
+        pc.db_writer.max_delay = 1000
+        pc.thread_postgres_write = MagicMock(spec=ProxyClient.thread_postgres_write)
+
+        for _ in range(pc.db_writer.max_rows - 1):
+            pc.db_write_queue.put(self._dwi())
+
+        pc.thread_postgres_read_queue()
+        self.assertEqual(pc.thread_postgres_write.call_count, 0)
+
+        pc.db_write_queue.put(self._dwi())
+        pc.thread_postgres_read_queue()
+        self.assertEqual(pc.thread_postgres_write.call_count, 1)
+        self.assertEqual(len(pc.thread_postgres_write.call_args.args[0][self.TEST_GUID]), pc.db_writer.max_rows)
+
+    def test_read_queue_fuzzer_skips(self):
+        pc = self._pcWithMockedConn(is_fuzzer=True)
+        pc.db_writer.max_delay = 0
+        pc.thread_postgres_write = MagicMock(spec=ProxyClient.thread_postgres_write)
+
+        pc.db_write_queue.put(self._dwi())
+        pc.thread_postgres_read_queue()
+
+        self.assertEqual(pc.thread_postgres_write.call_count, 0)
+
+    def test_read_queue_commits_spool(self):
+        pc = self._pcWithMockedConn()
+        pc.spool = pc.db_write_queue = MagicMock()
+        pc.spool.get_nowait.side_effect = [self._dwi(), queue.Empty]
+        pc.db_writer.max_delay = 0
+        pc.thread_postgres_write = MagicMock(spec=ProxyClient.thread_postgres_write)
+
+        pc.thread_postgres_read_queue()
+
+        self.assertEqual(pc.thread_postgres_write.call_count, 1)
+        self.assertEqual(pc.spool.commit.call_count, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+from http_proxy.h2_client import H2Connection, H2Exception, H2Pool
+from tests.test_base import TestBase
+from unittest.mock import MagicMock
+import h2.config
+import h2.connection
+import h2.errors
+import h2.events
+import unittest
+
+class FakeH2Socket(object):
+    """
+    Socket that answers every request with `response` through an in-memory
+    HTTP/2 server.
+    """
+    def __init__(self, status=b"200", content=b"OK", reset=False, reset_code=0):
+        config = h2.config.H2Configuration(client_side=False, header_encoding=None)
+        self.server = h2.connection.H2Connection(config=config)
+        self.server.initiate_connection()
+
+        self.status = status
+        self.content = content
+        self.reset = reset
+        self.reset_code = reset_code
+        self.requests = []
+
+    def sendall(self, data):
+        for event in self.server.receive_data(data):
+            if isinstance(event, h2.events.RequestReceived):
+                self.requests.append(dict(event.headers))
+            elif isinstance(event, h2.events.DataReceived):
+                self.server.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, h2.events.StreamEnded):
+                if self.reset:
+                    self.server.reset_stream(event.stream_id, self.reset_code)
+                    continue
+
+                self.server.send_headers(event.stream_id, [(b":status", self.status),
+                    (b"content-type", b"text/plain")])
+                self.server.send_data(event.stream_id, self.content, end_stream=True)
+
+    def recv(self, size):
+        return self.server.data_to_send()
+
+    def close(self):
+        pass
+
+class TestH2Client(TestBase):
+    """
+    This file contains tests related to h2_client.py.
+    """
+    def test_request(self):
+        sock = FakeH2Socket(status=b"404", content=b"Not here.")
+        conn = H2Connection(sock)
+
+        resp = conn.request(self._req().toMITM())
+
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.content, b"Not here.")
+        self.assertEqual(resp.http_version, "HTTP/1.1")
+        self.assertEqual(resp.reason, "Not Found")
+        self.assertEqual(resp.headers["content-type"], "text/plain")
+        self.assertEqual(resp.headers["content-length"], str(len(b"Not here.")))
+        self.assertIsNone(resp.trailers)
+
+        request = sock.requests[0]
+        self.assertEqual(request[b":method"], b"GET")
+        self.assertEqual(request[b":path"], b"/testpath")
+        self.assertEqual(request[b":authority"], b"www.testing.local")
+        assert b"host" not in request
+        assert b"connection" not in request
+
+    def test_request_reuses_connection(self):
+        sock = FakeH2Socket()
+        conn = H2Connection(sock)
+
+        conn.request(self._req().toMITM())
+        conn.request(self._req().toMITM())
+
+        self.assertEqual(len(sock.requests), 2)
+
+    def test_request_post_body(self):
+        sock = FakeH2Socket()
+        conn = H2Connection(sock)
+        req = self._req()
+        req.state['method'] = b"POST"
+        req.state['content'] = b"a" * 100000
+
+        resp = conn.request(req.toMITM())
+
+        self.assertEqual(resp.status_code, 200)
+
+    def test_stream_reset(self):
+        conn = H2Connection(FakeH2Socket(reset=True))
+
+        with self.assertRaises(H2Exception) as cm:
+            conn.request(self._req().toMITM())
+
+        assert not cm.exception.unprocessed
+
+    def test_stream_refused(self):
+        conn = H2Connection(FakeH2Socket(reset=True, reset_code=h2.errors.ErrorCodes.REFUSED_STREAM))
+
+        with self.assertRaises(H2Exception) as cm:
+            conn.request(self._req().toMITM())
+
+        assert cm.exception.unprocessed
+
+    def test_pool_evicts(self):
+        pool = H2Pool()
+        pool.MAX_CONNECTIONS = 1
+        first, second = MagicMock(is_open=True), MagicMock(is_open=True)
+
+        pool.put(("a", 443), first)
+        pool.put(("b", 443), second)
+
+        self.assertEqual(pool.get(("a", 443)), None)
+        self.assertEqual(pool.get(("b", 443)), second)
+        self.assertEqual(first.close.call_count, 1)
+
+if __name__ == '__main__':
+    unittest.main()
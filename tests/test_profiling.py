@@ -0,0 +1,62 @@
+from http_proxy.profiling import SamplingProfiler
+import glob
+import os
+import tempfile
+import threading
+import unittest
+
+def busy_function(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+class TestProfiling(unittest.TestCase):
+    """
+    This file contains tests related to profiling.py.
+    """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.profiler = SamplingProfiler(self.tmp.name, "test")
+
+        self.stop = threading.Event()
+        self.busy = threading.Thread(target=busy_function, args=(self.stop,), name="busy")
+        self.busy.start()
+
+    def tearDown(self):
+        self.stop.set()
+        self.busy.join()
+        self.tmp.cleanup()
+
+    def _files(self, suffix):
+        return glob.glob(os.path.join(self.tmp.name, "test-*" + suffix))
+
+    def test_folded_stacks(self):
+        self.assertTrue(self.profiler.start(duration=0.2))
+        self.profiler.thread.join()
+
+        files = self._files(".folded")
+        self.assertEqual(len(files), 1)
+
+        with open(files[0]) as f:
+            lines = f.read().splitlines()
+
+        busy = [line for line in lines if line.startswith("busy;")]
+        self.assertTrue(any(["test_profiling.py:busy_function" in line for line in busy]))
+        self.assertFalse(any(["profiler;" in line for line in lines]))
+        self.assertEqual(self._files(".tracemalloc.txt"), [])
+
+    def test_single_session(self):
+        self.assertTrue(self.profiler.start(duration=10))
+        self.assertFalse(self.profiler.start(duration=10))
+
+        self.profiler.stop()
+        self.assertFalse(self.profiler.running)
+        self.assertEqual(len(self._files(".folded")), 1)
+
+    def test_memory(self):
+        self.assertTrue(self.profiler.start(duration=0.1, memory=True))
+        self.profiler.thread.join()
+
+        self.assertEqual(len(self._files(".tracemalloc.txt")), 1)
+
+if __name__ == '__main__':
+    unittest.main()
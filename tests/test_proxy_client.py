@@ -0,0 +1,141 @@
+from http_proxy.metrics import registry
+from http_proxy.proxy_client import ProxyClient, ThreadsDeadException
+from tests.test_base import TestBase
+from unicornbottle.models import Request
+from unicornbottle.proxy import TimeoutException
+from unittest.mock import MagicMock
+import asyncio
+import unittest
+import uuid
+
+class TestProxyClient(TestBase):
+    """
+    This file contains tests related to the RPC side of proxy_client.py.
+    """
+    def _replyWith(self, pc, body):
+        """
+        Makes the mocked connection deliver `body` as the reply as soon as a
+        request is published.
+        """
+        def publish(callback):
+            props = callback.keywords['properties']
+            pc.on_response(None, None, props, body)
+
+        pc.rabbit_connection.add_callback_threadsafe.side_effect = publish
+
+    def test_send_request(self):
+        pc = self._pcWithMockedConn()
+        resp = self._resp()
+        resp.state['status_code'] = 309
+        self._replyWith(pc, resp.toJSON())
+
+        corr_id = str(uuid.uuid4())
+        ret = pc.send_request(self._req().toMITM(), corr_id)
+
+        self.assertEqual(ret.status_code, 309)
+        self.assertEqual(len(pc.pending), 0)
+
+        callback = pc.rabbit_connection.add_callback_threadsafe.call_args.args[0]
+        self.assertEqual(callback.func, pc.channel.basic_publish)
+        self.assertEqual(callback.keywords['properties'].correlation_id, corr_id)
+        self.assertEqual(callback.keywords['properties'].reply_to, pc.callback_queue)
+
+    def test_send_request_timeout(self):
+        pc = self._pcWithMockedConn()
+        pc.REQUEST_TIMEOUT = 0.00001
+
+        with self.assertRaises(TimeoutException):
+            pc.send_request(self._req().toMITM(), "corr_id")
+
+        self.assertEqual(len(pc.pending), 0)
+
+    def test_send_request_threads_dead(self):
+        pc = self._pcWithMockedConn()
+        pc.threads_alive.return_value = False
+
+        with self.assertRaises(ThreadsDeadException):
+            pc.send_request(self._req().toMITM(), "corr_id")
+
+        with self.assertRaises(ThreadsDeadException):
+            asyncio.run(pc.send_request_async(self._req().toMITM(), "corr_id"))
+
+        self.assertEqual(pc.rabbit_connection.add_callback_threadsafe.call_count, 0)
+        self.assertEqual(len(pc.pending), 0)
+
+    def test_send_request_async(self):
+        pc = self._pcWithMockedConn()
+        resp = self._resp()
+        resp.state['status_code'] = 309
+        self._replyWith(pc, resp.toJSON())
+
+        ret = asyncio.run(pc.send_request_async(self._req().toMITM(), str(uuid.uuid4())))
+
+        self.assertEqual(ret.status_code, 309)
+        self.assertEqual(len(pc.pending), 0)
+
+    def test_send_request_async_timeout(self):
+        pc = self._pcWithMockedConn()
+        pc.REQUEST_TIMEOUT = 0.00001
+
+        with self.assertRaises(TimeoutException):
+            asyncio.run(pc.send_request_async(self._req().toMITM(), "corr_id"))
+
+        self.assertEqual(len(pc.pending), 0)
+
+    def test_late_reply_dropped(self):
+        pc = self._pcWithMockedConn()
+        props = MagicMock(correlation_id="late")
+
+        before = registry.counters.get("rpc.late_replies", 0)
+        pc.on_response(None, None, props, self._resp().toJSON())
+
+        self.assertEqual(len(pc.pending), 0)
+        self.assertEqual(registry.counters["rpc.late_replies"], before + 1)
+
+    def test_evict_expired(self):
+        pc = self._pcWithMockedConn()
+        pc.pending.register("stale", -1)
+        pc.pending.register("fresh", 1000)
+
+        self.assertEqual(pc.pending.evict_expired(), 1)
+        self.assertEqual(len(pc.pending), 1)
+
+    def test_read_queue_keeps_pending(self):
+        pc = self._pcWithMockedConn()
+        pending = pc.pending
+        pending.register("in-flight", 1000)
+
+        pc.thread_postgres_read_queue()
+
+        self.assertIs(pc.pending, pending)
+        self.assertIsNotNone(pc.pending.get("in-flight"))
+
+    def test_modify_headers(self):
+        pc = self._pcWithMockedConn()
+        pc.db_write_queue = MagicMock()
+        self._replyWith(pc, self._resp().toJSON())
+
+        pc.send_request(self._req().toMITM(), str(uuid.uuid4()))
+
+        callback = pc.rabbit_connection.add_callback_threadsafe.call_args.args[0]
+        headers = Request.fromJSON(callback.keywords['body']).state['headers']
+        assert [b'X-Hackerone', b'benteveo'] in headers
+        assert pc.UB_GUID_HEADER.encode('utf-8') not in [h[0] for h in headers]
+
+        dwi = pc.db_write_queue.put.call_args[0][0]
+        assert pc.UB_GUID_HEADER in dwi.request.headers
+
+    def test_queue_write_exception(self):
+        pc = self._pcWithMockedConn()
+        pc.db_write_queue = MagicMock()
+        pc.rabbit_connection.add_callback_threadsafe.side_effect = ValueError("Oops.")
+
+        with self.assertRaises(ValueError):
+            pc.send_request(self._req().toMITM(), str(uuid.uuid4()))
+
+        dwi = pc.db_write_queue.put.call_args[0][0]
+        self.assertEqual(dwi.exception.state['type'], "ValueError")
+        self.assertEqual(dwi.response, None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+from http_proxy import rpc_server
+from http_proxy.capture import CapturedRequest
+from http_proxy.replay import ClientTarget, Replayer, Report, ServerTarget, StubOrigin, Target
+from tests.test_base import TestBase
+from unicornbottle.proxy import TimeoutException
+import time
+import unittest
+
+class RecordingTarget(Target):
+    def __init__(self):
+        self.sent = []
+
+    def prepare(self, captured):
+        return captured.body
+
+    def send(self, prepared):
+        self.sent.append((time.perf_counter(), prepared))
+        if prepared == b"fail":
+            raise Exception("Failed.")
+
+        return 200
+
+class TestReplay(TestBase):
+    """
+    This file contains tests related to replay.py.
+    """
+    def _captured(self, timestamp=0.0):
+        return CapturedRequest(timestamp, self._req().toJSON().encode('utf-8'))
+
+    def test_percentile(self):
+        report = Report()
+        for i in range(1, 101):
+            report.add(i / 1000.0, 200)
+
+        self.assertEqual(report.percentile(50), 0.05)
+        self.assertEqual(report.percentile(99), 0.099)
+        self.assertEqual(report.percentile(100), 0.1)
+
+    def test_run(self):
+        target = RecordingTarget()
+        captures = [CapturedRequest(0.0, b"ok"), CapturedRequest(0.0, b"fail")]
+
+        report = Replayer(target, concurrency=2).run(captures)
+
+        self.assertEqual(len(target.sent), 2)
+        self.assertEqual(report.nb_requests, 2)
+        self.assertEqual(report.nb_exceptions, 1)
+        self.assertEqual(report.status_codes[200], 1)
+
+    def test_schedule(self):
+        captures = [CapturedRequest(10.0, b""), CapturedRequest(11.0, b""), CapturedRequest(14.0, b"")]
+
+        self.assertEqual(Replayer(RecordingTarget(), rate=2).schedule(captures), [0.0, 0.5, 1.0])
+        self.assertEqual(Replayer(RecordingTarget(), speedup=2).schedule(captures), [0.0, 0.5, 2.0])
+
+    def test_rate_and_speedup(self):
+        with self.assertRaises(ValueError):
+            Replayer(RecordingTarget(), rate=1, speedup=1)
+
+    def test_server_target(self):
+        origin = StubOrigin(body_size=100)
+        origin.start()
+        try:
+            target = ServerTarget(origin.address)
+            report = Replayer(target, concurrency=2).run([self._captured(), self._captured()])
+        finally:
+            origin.stop()
+
+        self.assertEqual(report.nb_exceptions, 0)
+        self.assertEqual(report.status_codes[200], 2)
+
+    def test_server_target_passthrough(self):
+        server = ServerTarget().get_server()
+
+        self.assertEqual(server.passthrough, rpc_server.PASSTHROUGH)
+
+    def test_target_abstract(self):
+        with self.assertRaises(TypeError):
+            Target()
+
+    def test_client_target_no_db_writes(self):
+        pc = self._pcWithMockedConn()
+        pc.REQUEST_TIMEOUT = 0.00001
+        target = ClientTarget(pc)
+
+        prepared = target.prepare(self._captured())
+        with self.assertRaises(TimeoutException):
+            target.send(prepared)
+
+        self.assertEqual(pc.rabbit_connection.add_callback_threadsafe.call_count, 1)
+        assert pc.db_write_queue.empty()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+from http_proxy import routing
+from http_proxy.routing import HashRing
+from tests.test_base import TestBase
+import unittest
+
+class TestRouting(TestBase):
+    """
+    This file contains tests related to routing.py.
+    """
+    KEYS = ["host-%s.example.org:443" % i for i in range(2000)]
+
+    def test_shard_for_stable(self):
+        ring = HashRing(16)
+
+        self.assertEqual([ring.shard_for(k) for k in self.KEYS], [ring.shard_for(k) for k in self.KEYS])
+        self.assertEqual(len(set([ring.shard_for(k) for k in self.KEYS])), 16)
+
+    def test_adding_shard_moves_few_keys(self):
+        before = HashRing(16)
+        after = HashRing(17)
+
+        moved = [k for k in self.KEYS if before.shard_for(k) != after.shard_for(k)]
+
+        # Ideally 1/17th of the keys move, all of them to the new shard.
+        self.assertLess(len(moved), len(self.KEYS) / 8)
+        self.assertEqual(set([after.shard_for(k) for k in moved]), {16})
+
+    def test_routing_key_ignores_port_in_host(self):
+        self.assertEqual(routing.routing_key_for("www.testing.local:8080", 8080),
+                routing.routing_key_for("www.testing.local", 8080))
+        assert routing.routing_key_for("www.testing.local", 80).startswith(routing.SHARD_QUEUE_PREFIX)
+
+    def test_consume_shards(self):
+        channel = self._mockChannel()
+
+        routing.consume_shards(channel, 3, "callback", nb_shards=4)
+
+        priorities = {c.kwargs['queue']: c.kwargs['arguments']['x-priority'] for c in channel.basic_consume.call_args_list}
+        self.assertEqual(priorities, {
+            routing.shard_queue(0): routing.STEAL_PRIORITY,
+            routing.shard_queue(1): routing.STEAL_PRIORITY,
+            routing.shard_queue(2): routing.STEAL_PRIORITY,
+            routing.shard_queue(3): routing.HOME_PRIORITY,
+        })
+
+    def test_proxy_client_routing_key(self):
+        pc = self._pcWithMockedConn()
+        req = self._req().toMITM()
+
+        self.assertEqual(pc.get_routing_key(req), 'rpc_queue')
+
+        pc.host_affinity = True
+        self.assertEqual(pc.get_routing_key(req), routing.routing_key_for("www.testing.local", 80))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,13 @@
-from http_proxy.rpc_client import HTTPProxyAddon
+from http_proxy.admission import AdmissionController
+from http_proxy.proxy_client import ProxyClient
+from http_proxy.rpc_client import AsyncHTTPProxyAddon, HTTPProxyAddon
 from sqlalchemy import exc
 from tests.test_base import TestBase
 from unicornbottle.models import DatabaseWriteItem, RequestResponse
 from unicornbottle.models import Request
 from unicornbottle.proxy import HTTPProxyClient, TimeoutException, UnauthorizedException
-from unittest.mock import MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
+import asyncio
 import base64
 import json
 import mitmproxy
@@ -125,6 +128,74 @@ class TestRPCClient(TestBase):
         self.assertEqual(len(flow.response.headers), len(response.state['headers']))
         self.assertEqual(flow.response.content, response.state['content'])
 
+    def test_async_request_method(self):
+        response = self._resp()
+        client = MagicMock(spec=ProxyClient)
+        client.send_request_async = AsyncMock(return_value=response.toMITM())
+
+        flow = self._mockFlow()
+        flow.reply = MagicMock()
+        flow.reply.state = "taken"
+        flow.reply.has_message = False
+
+        addon = AsyncHTTPProxyAddon(client)
+        asyncio.run(addon._request_async(flow))
+
+        self.assertEqual(client.send_request_async.await_count, 1)
+        self.assertEqual(flow.response.content, response.state['content'])
+        self.assertEqual(flow.reply.ack.call_count, 1)
+        self.assertEqual(flow.reply.commit.call_count, 1)
+
+    def test_async_request_method_exception(self):
+        client = MagicMock(spec=ProxyClient)
+        client.send_request_async = AsyncMock(side_effect=TimeoutException("Timed out."))
+
+        flow = self._mockFlow()
+        flow.reply = MagicMock()
+        flow.reply.state = "taken"
+
+        addon = AsyncHTTPProxyAddon(client)
+        asyncio.run(addon._request_async(flow))
+
+        self.assertEqual(flow.response.status_code, 502)
+        self.assertEqual(flow.reply.commit.call_count, 1)
+
+    def test_request_method_shed(self):
+        client = self._mockHTTPClient()
+        flow = self._mockFlow()
+
+        addon = HTTPProxyAddon(client, AdmissionController(0, retry_after=7))
+        addon._request(flow)
+
+        self.assertEqual(client.send_request.call_count, 0)
+        self.assertEqual(flow.response.status_code, 503)
+        self.assertEqual(flow.response.headers["Retry-After"], "7")
+
+    def test_request_method_releases(self):
+        client = self._mockHTTPClient()
+        client.send_request.side_effect = TimeoutException("Timed out.")
+        admission = AdmissionController(1)
+
+        addon = HTTPProxyAddon(client, admission)
+        addon._request(self._mockFlow())
+
+        self.assertEqual(admission.outstanding, 0)
+
+    def test_async_request_method_shed(self):
+        client = MagicMock(spec=ProxyClient)
+        client.send_request_async = AsyncMock()
+
+        flow = self._mockFlow()
+        flow.reply = MagicMock()
+        flow.reply.state = "taken"
+
+        addon = AsyncHTTPProxyAddon(client, AdmissionController(0))
+        asyncio.run(addon._request_async(flow))
+
+        self.assertEqual(client.send_request_async.await_count, 0)
+        self.assertEqual(flow.response.status_code, 503)
+        self.assertEqual(flow.reply.commit.call_count, 1)
+
     def test_queue_write_success(self):
         hpc = self._hpcWithMockedConn() 
         hpc.db_write_queue = MagicMock()
@@ -1,10 +1,13 @@
-from http_proxy.rpc_server import RPCServer
+from http_proxy.h2_client import H2Exception
+from http_proxy.rpc_server import RPCServer, listen
 from http_proxy.models import Response, Request
 from tests.test_base import TestBase
 from io import BytesIO
 from unittest.mock import MagicMock, patch
 import base64
+import gzip
 import pika
+import pika.exceptions
 import json
 
 class TestRPCServer(TestBase):
@@ -104,3 +107,105 @@ class TestRPCServer(TestBase):
         self.assertEqual(sock_instance.connect.call_count, 1)
         self.assertEqual(sock_instance.connect.call_args[0][0], ('host', 8080))
 
+    def _gzipReq(self):
+        req = self._req().toMITM()
+        req.method = "POST"
+        req.headers["content-encoding"] = "gzip"
+        req.raw_content = gzip.compress(b"plaintext body")
+
+        return req
+
+    def test_get_raw_request_passthrough(self):
+        req = self._gzipReq()
+        body = req.raw_content
+
+        raw = RPCServer(passthrough=True).get_raw_request(req)
+
+        self.assertTrue(raw.endswith(body))
+        self.assertIn(b"content-encoding: gzip", raw.lower())
+
+    def test_get_raw_request_decodes(self):
+        raw = RPCServer(passthrough=False).get_raw_request(self._gzipReq())
+
+        self.assertTrue(raw.endswith(b"plaintext body"))
+        self.assertNotIn(b"content-encoding", raw.lower())
+
+    @patch("ssl.create_default_context", autospec=True)
+    @patch("socket.socket", autospec=True)
+    def test_get_socket_alpn(self, socket, ssl_cdc):
+        req = self._req()
+        req.state['scheme'] = 'https'
+
+        self._getServer().get_socket(req.toMITM())
+        ssl_cdc.return_value.set_alpn_protocols.assert_called_with(["h2", "http/1.1"])
+
+        ssl_cdc.reset_mock()
+        RPCServer(http2=False).get_socket(req.toMITM())
+        self.assertEqual(ssl_cdc.return_value.set_alpn_protocols.call_count, 0)
+
+    def test_send_request_reuses_h2(self):
+        server = self._getServer()
+        server.get_socket = MagicMock(spec=RPCServer.get_socket)
+        h2_conn = MagicMock(is_open=True)
+        server.get_h2_pool().put(('www.testing.local', 80), h2_conn)
+
+        resp = server.send_request(self._req().toMITM())
+
+        self.assertEqual(resp, h2_conn.request.return_value)
+        self.assertEqual(server.get_socket.call_count, 0)
+
+    def _serverWithFailingH2(self, exception):
+        server = self._getServer()
+        server.get_socket = MagicMock(spec=RPCServer.get_socket)
+        server.get_socket.return_value.connect.side_effect = ConnectionRefusedError
+        h2_conn = MagicMock(is_open=True)
+        h2_conn.request.side_effect = exception
+        server.get_h2_pool().put(('www.testing.local', 80), h2_conn)
+
+        return server
+
+    def test_send_request_h2_retries_idempotent(self):
+        server = self._serverWithFailingH2(H2Exception("Connection closed by server."))
+
+        with self.assertRaises(ConnectionRefusedError):
+            server.send_request(self._req().toMITM())
+
+        self.assertEqual(server.get_socket.call_count, 1)
+
+    def test_send_request_h2_no_retry_post(self):
+        server = self._serverWithFailingH2(H2Exception("Connection closed by server."))
+        req = self._req()
+        req.state['method'] = b'POST'
+
+        with self.assertRaises(H2Exception):
+            server.send_request(req.toMITM())
+
+        self.assertEqual(server.get_socket.call_count, 0)
+        self.assertIsNone(server.get_h2_pool().get(('www.testing.local', 80)))
+
+    def test_send_request_h2_retries_unprocessed_post(self):
+        server = self._serverWithFailingH2(H2Exception("Stream refused.", unprocessed=True))
+        req = self._req()
+        req.state['method'] = b'POST'
+
+        with self.assertRaises(ConnectionRefusedError):
+            server.send_request(req.toMITM())
+
+        self.assertEqual(server.get_socket.call_count, 1)
+
+    @patch("time.sleep")
+    @patch("http_proxy.rpc_server.rabbitmq_connect")
+    def test_listen_reconnects(self, rabbitmq_connect, sleep):
+        lost = self._mockConnection()
+        lost.channel.return_value.start_consuming.side_effect = pika.exceptions.ConnectionClosedByBroker(320, "CONNECTION_FORCED")
+
+        interrupted = self._mockConnection()
+        interrupted.channel.return_value.start_consuming.side_effect = KeyboardInterrupt
+
+        rabbitmq_connect.side_effect = [pika.exceptions.AMQPConnectionError(), lost, interrupted]
+
+        listen()
+
+        self.assertEqual(rabbitmq_connect.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(interrupted.close.call_count, 1)
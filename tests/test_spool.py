@@ -0,0 +1,106 @@
+from http_proxy.metrics import registry
+from http_proxy.spool import Spool
+import os
+import queue
+import tempfile
+import unittest
+
+class TestSpool(unittest.TestCase):
+    """
+    This file contains tests related to spool.py.
+    """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_put_get(self):
+        spool = Spool(self.directory, segment_size=4096)
+        spool.put({"a": 1})
+        spool.put({"b": 2})
+
+        self.assertEqual(spool.qsize(), 2)
+        self.assertEqual(spool.get_nowait(), {"a": 1})
+        self.assertEqual(spool.get_nowait(), {"b": 2})
+
+        with self.assertRaises(queue.Empty):
+            spool.get_nowait()
+
+    def test_replay_uncommitted(self):
+        spool = Spool(self.directory, segment_size=4096)
+        spool.put("first")
+        spool.put("second")
+        spool.get_nowait()
+        spool.commit()
+        spool.get_nowait() # read, but never committed.
+        spool.close()
+
+        spool = Spool(self.directory, segment_size=4096)
+        self.assertEqual(spool.qsize(), 1)
+        self.assertEqual(spool.get_nowait(), "second")
+
+        spool.put("third")
+        self.assertEqual(spool.get_nowait(), "third")
+
+    def test_segments_deleted_on_commit(self):
+        spool = Spool(self.directory, segment_size=4096)
+        for i in range(100):
+            spool.put(b"x" * 100)
+
+        self.assertGreater(len(spool.list_segments()), 1)
+
+        for i in range(100):
+            spool.get_nowait()
+        spool.commit()
+
+        self.assertEqual(len(spool.list_segments()), 1)
+        self.assertEqual(spool.lag_bytes(), 0)
+
+    def test_quota_drops(self):
+        spool = Spool(self.directory, segment_size=4096, quota=8192)
+        for i in range(100):
+            spool.put(b"x" * 100)
+
+        self.assertLess(spool.qsize(), 100)
+        self.assertLessEqual(len(spool.list_segments()) * 4096, 8192)
+
+    def test_oversized_record(self):
+        spool = Spool(self.directory, segment_size=4096)
+        spool.put(b"small")
+        spool.put(b"x" * 10000)
+        spool.put(b"after")
+        spool.close()
+
+        spool = Spool(self.directory, segment_size=4096)
+        self.assertEqual(spool.qsize(), 3)
+        self.assertEqual(spool.get_nowait(), b"small")
+        self.assertEqual(spool.get_nowait(), b"x" * 10000)
+        self.assertEqual(spool.get_nowait(), b"after")
+
+        spool.commit()
+        self.assertEqual(spool.lag_bytes(), 0)
+        self.assertEqual(len(spool.list_segments()), 1)
+
+    def test_oversized_record_over_quota(self):
+        spool = Spool(self.directory, segment_size=4096, quota=8192)
+        dropped = registry.counters.get("spool.dropped_oversize", 0)
+
+        spool.put(b"x" * 10000)
+
+        self.assertEqual(spool.qsize(), 0)
+        self.assertEqual(registry.counters["spool.dropped_oversize"], dropped + 1)
+
+    def test_open_free(self):
+        first = Spool.open_free(self.directory, segment_size=4096)
+        second = Spool.open_free(self.directory, segment_size=4096)
+
+        self.assertNotEqual(first.directory, second.directory)
+
+        first.close()
+        third = Spool.open_free(self.directory, segment_size=4096)
+        self.assertEqual(first.directory, third.directory)
+
+if __name__ == '__main__':
+    unittest.main()